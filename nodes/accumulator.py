@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Rain accumulation by calendar period.
+
+Observations are placed in hour, day, week, month and year buckets
+using the observation's timestamp in the station's timezone.  The
+start and end of the current periods are calculated when a period
+rolls over, so adding an observation is normally just a comparison
+against the end of the current hour.
+"""
+import datetime
+import time
+import udi_interface
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+LOGGER = udi_interface.LOGGER
+
+PERIODS = ('hourly', 'daily', 'weekly', 'monthly', 'yearly')
+
+
+class Calendar(object):
+    def __init__(self, timezone=None):
+        self.tz = None
+        if timezone is not None and ZoneInfo is not None:
+            try:
+                self.tz = ZoneInfo(timezone)
+            except Exception as e:
+                LOGGER.warning('Unknown timezone {}, using local time: {}'.format(timezone, e))
+
+    def _local(self, ts):
+        if self.tz is None:
+            return datetime.datetime.fromtimestamp(ts).astimezone()
+        return datetime.datetime.fromtimestamp(ts, self.tz)
+
+    def _midnight(self, date):
+        dt = datetime.datetime.combine(date, datetime.time(0))
+        if self.tz is None:
+            return dt.astimezone().timestamp()
+        return dt.replace(tzinfo=self.tz).timestamp()
+
+    def boundaries(self, ts):
+        """
+          Return a dictionary of (start, end) epoch times for each
+          period that contains ts.  Weeks start on Monday to match
+          isocalendar().
+        """
+        dt = self._local(ts)
+        day = dt.date()
+
+        hour_start = int(ts) - (dt.minute * 60) - dt.second
+        day_start = self._midnight(day)
+        week_day = day - datetime.timedelta(days=day.weekday())
+        month_day = day.replace(day=1)
+        if month_day.month == 12:
+            next_month = month_day.replace(year=month_day.year + 1, month=1)
+        else:
+            next_month = month_day.replace(month=month_day.month + 1)
+        year_day = day.replace(month=1, day=1)
+
+        return {
+                'hourly': (hour_start, hour_start + 3600),
+                'daily': (day_start, self._midnight(day + datetime.timedelta(days=1))),
+                'weekly': (self._midnight(week_day), self._midnight(week_day + datetime.timedelta(days=7))),
+                'monthly': (self._midnight(month_day), self._midnight(next_month)),
+                'yearly': (self._midnight(year_day), self._midnight(year_day.replace(year=year_day.year + 1))),
+                }
+
+
+class RainAccumulator(object):
+    """
+      Accumulate the regular and nearcast rain for one device.  The
+      totals are kept in the rd and nc_rd dictionaries used by the
+      nodes.  Keys are the period names plus 'yesterday', with an 'nc_'
+      prefix for the nearcast values.
+
+      Both sets of totals share the same period boundaries, so each
+      observation is checked against the calendar once.  After adding
+      an observation, publish() updates the drivers on the rain node
+      and the nearcast rain node (if there is one).
+    """
+    def __init__(self, rd, nc_rd=None, timezone=None, now=None):
+        self.rd = rd
+        self.nc_rd = nc_rd if nc_rd is not None else {}
+        self.node = None
+        self.nc_node = None
+        self.calendar = Calendar(timezone)
+        self.columns = ((self.rd, self._keys(self.rd, '')),
+                        (self.nc_rd, self._keys(self.nc_rd, 'nc_')))
+
+        self.set_periods(time.time() if now is None else now)
+
+    def _keys(self, rd, prefix):
+        keys = {}
+        for p in PERIODS + ('yesterday',):
+            keys[p] = prefix + p
+            if keys[p] not in rd:
+                rd[keys[p]] = 0
+        return keys
+
+    def set_periods(self, ts):
+        self.bounds = self.calendar.boundaries(ts)
+        day_start = self.bounds['daily'][0]
+        self.yesterday_start = self.calendar.boundaries(day_start - 1)['daily'][0]
+        self.hour_start, self.next_hour = self.bounds['hourly']
+
+    def rollover(self, ts):
+        old = self.bounds
+        self.set_periods(ts)
+        for p in PERIODS:
+            if self.bounds[p][0] == old[p][0]:
+                continue
+            for (rd, keys) in self.columns:
+                if p == 'daily':
+                    # Only if the old day was the day before this one
+                    if self.bounds['daily'][0] == old['daily'][1]:
+                        rd[keys['yesterday']] = rd[keys['daily']]
+                    else:
+                        rd[keys['yesterday']] = 0
+                rd[keys[p]] = 0
+
+    def _add(self, rd, keys, ts, rain):
+        if ts >= self.hour_start:
+            for p in PERIODS:
+                rd[keys[p]] += rain
+            return
+
+        # A late observation.  Only add it to the periods it belongs to.
+        for p in PERIODS:
+            if ts >= self.bounds[p][0]:
+                rd[keys[p]] += rain
+        if self.yesterday_start <= ts < self.bounds['daily'][0]:
+            rd[keys['yesterday']] += rain
+
+    def add(self, ts, rain, rain_nc=None):
+        """
+          Add one observation.  rain_nc is None when the observation
+          doesn't include nearcast rain (UDP data).
+        """
+        if ts >= self.next_hour:
+            self.rollover(ts)
+
+        if rain is not None:
+            self._add(self.rd, self.columns[0][1], ts, rain)
+        if rain_nc is not None:
+            self._add(self.nc_rd, self.columns[1][1], ts, rain_nc)
+
+    def publish(self, force=False):
+        if self.node is not None:
+            self.node.rain_publish(force)
+        if self.nc_node is not None:
+            self.nc_node.rain_publish(force)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Per device mailboxes.
+
+Everything that changes a device's state (node drivers, wind averages,
+rain accumulation, history) is submitted to that device's mailbox.  A
+mailbox is drained by one worker at a time, in the order things were
+submitted, so the state only ever has one writer and doesn't need
+locks.  Different mailboxes are drained in parallel by a small thread
+pool, so a slow publish for one device doesn't hold up the others.
+
+Work is never dropped, except work submitted with submit_latest (rapid
+wind, publishing current state).  When the mailbox is backed up a newer
+call to the same function takes the place of the one already waiting.
+"""
+import collections
+import threading
+import time
+import udi_interface
+from concurrent.futures import Future, ThreadPoolExecutor
+
+LOGGER = udi_interface.LOGGER
+
+WORKERS = 4
+MAX_PENDING = 1000      # per mailbox, replaceable work is dropped after this
+DROP_LOG_INTERVAL = 60  # seconds between warnings about dropped work
+
+
+class ActorPool(object):
+    def __init__(self, workers=WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='actor')
+        self.lock = threading.Lock()
+        self.mailboxes = {}     # key -> deque of [function, args, kwargs]
+        self.latest = {}        # (key, function) -> waiting submit_latest entry
+        self.running = set()    # keys that have a worker draining them
+        self.idle = threading.Condition(self.lock)
+        self.stopped = False
+        self.dropped = collections.Counter()    # key -> work dropped
+        self.drop_logged = {}                   # key -> (time, dropped) of the last warning
+        self.backlogged = set()                 # keys over MAX_PENDING
+
+    def submit(self, key, function, *args, **kwargs):
+        """ Queue function(*args, **kwargs) to run in key's mailbox """
+        self._submit(key, function, args, kwargs, False)
+
+    def submit_latest(self, key, function, *args, **kwargs):
+        """
+          Queue work that a later call to the same function makes
+          unnecessary.  If the mailbox is full the call takes the place
+          of the one to function already waiting.
+        """
+        self._submit(key, function, args, kwargs, True)
+
+    def _submit(self, key, function, args, kwargs, replaceable):
+        warning = None
+        with self.lock:
+            if self.stopped:
+                return
+            mailbox = self.mailboxes.get(key)
+            if mailbox is None:
+                mailbox = collections.deque()
+                self.mailboxes[key] = mailbox
+
+            waiting = self.latest.get((key, function)) if replaceable else None
+            if waiting is not None and len(mailbox) >= MAX_PENDING:
+                # The newer call takes the waiting one's place
+                waiting[1] = args
+                waiting[2] = kwargs
+                self.dropped[key] += 1
+                warning = self._drop_warning(key, function)
+            else:
+                if len(mailbox) >= MAX_PENDING:
+                    if key not in self.backlogged:
+                        self.backlogged.add(key)
+                        warning = 'Mailbox {} has more than {} items waiting'.format(key, MAX_PENDING)
+                elif key in self.backlogged:
+                    self.backlogged.discard(key)
+                entry = [function, args, kwargs]
+                mailbox.append(entry)
+                if replaceable:
+                    self.latest[(key, function)] = entry
+
+            start = key not in self.running
+            self.running.add(key)
+
+        if warning is not None:
+            LOGGER.warning(warning)
+        if start:
+            self.pool.submit(self._drain, key)
+
+    def _drop_warning(self, key, function):
+        """ The first drop for key and then a count every DROP_LOG_INTERVAL, lock held """
+        now = time.monotonic()
+        last = self.drop_logged.get(key)
+        if last is None:
+            self.drop_logged[key] = (now, self.dropped[key])
+            return 'Mailbox {} is full, replacing waiting {} calls with newer ones'.format(
+                key, getattr(function, '__name__', function))
+        if now - last[0] >= DROP_LOG_INTERVAL:
+            self.drop_logged[key] = (now, self.dropped[key])
+            return 'Mailbox {} is full, replaced {} more in the last {:.0f} seconds ({} in all)'.format(
+                key, self.dropped[key] - last[1], now - last[0], self.dropped[key])
+        return None
+
+    def call(self, key, function, *args, **kwargs):
+        """
+          Like submit, but returns a Future with the result.  Use this to
+          read state owned by the mailbox from another thread.
+        """
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(function(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+        run.__name__ = getattr(function, '__name__', 'call')
+
+        with self.lock:
+            stopped = self.stopped
+        if stopped:
+            future.set_exception(RuntimeError('Actor pool is stopped'))
+        else:
+            self.submit(key, run)
+        return future
+
+    def _drain(self, key):
+        while True:
+            with self.lock:
+                mailbox = self.mailboxes[key]
+                if len(mailbox) == 0 or self.stopped:
+                    self.running.discard(key)
+                    self.idle.notify_all()
+                    return
+                entry = mailbox.popleft()
+                function, args, kwargs = entry
+                if self.latest.get((key, function)) is entry:
+                    del self.latest[(key, function)]
+
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                LOGGER.error('{} failed for {}: {}'.format(getattr(function, '__name__', function), key, e))
+
+    def pending(self, key):
+        with self.lock:
+            mailbox = self.mailboxes.get(key)
+            return len(mailbox) if mailbox is not None else 0
+
+    def wait(self, timeout=None):
+        """ Wait until every mailbox is empty.  Returns False on timeout """
+        with self.lock:
+            return self.idle.wait_for(lambda: len(self.running) == 0, timeout)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.idle.notify_all()
+        self.pool.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    # Check ordering per key and that a slow key doesn't block the rest
+    import time
+
+    actors = ActorPool()
+    results = collections.defaultdict(list)
+
+    def work(key, i, delay):
+        if delay:
+            time.sleep(delay)
+        results[key].append(i)
+
+    start = time.time()
+    for i in range(20):
+        actors.submit('slow', work, 'slow', i, 0.05)
+        for d in range(10):
+            actors.submit(d, work, d, i, 0)
+    while any(len(results[d]) < 20 for d in range(10)):
+        time.sleep(0.001)
+    fast = time.time() - start
+    actors.wait()
+    total = time.time() - start
+
+    ordered = all(results[k] == list(range(20)) for k in results)
+    print('in order {}, fast devices done in {:.3f}s, slow device {:.3f}s'.format(ordered, fast, total))
+
+    # Back up one mailbox: observations are all kept, newer replaceable
+    # work takes the place of older work and only a warning or two is
+    # logged.
+    gate = threading.Event()
+    actors.submit('busy', gate.wait)
+    for i in range(MAX_PENDING + 500):
+        actors.submit('busy', work, 'obs', i, 0)
+        actors.submit_latest('busy', work, 'wind', i, 0)
+    gate.set()
+    actors.wait()
+    print('observations kept {}, wind kept {} of {}, replaced {}'.format(
+        results['obs'] == list(range(MAX_PENDING + 500)), len(results['wind']),
+        MAX_PENDING + 500, actors.dropped['busy']))
+    actors.stop()
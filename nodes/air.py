@@ -26,17 +26,34 @@ class AirNode(udi_interface.Node):
             {'driver': 'GV2',     'value': 0, 'uom': 56,  'name': 'Lightning Strikes'},      # lightning Strikes
             {'driver': 'DISTANC', 'value': 0, 'uom': 83,  'name': 'Lightning Distance'},  # lightning Distance
             {'driver': 'BATLVL',  'value': 0, 'uom': 72,  'name': 'Battery'},   # battery
+            {'driver': 'GV3',     'value': 0, 'uom': 17,  'name': 'Wet Bulb'},   # wet bulb
+            {'driver': 'GV4',     'value': 0, 'uom': 56,  'name': 'Air Density'},   # air density
+            {'driver': 'GV5',     'value': 0, 'uom': 25,  'name': 'Data Source'},  # UDP, REST or WebSocket
+            {'driver': 'GV6',     'value': 0, 'uom': 56,  'name': 'Strikes 10 Minutes'},  # strike events, 10 min
+            {'driver': 'GV7',     'value': 0, 'uom': 83,  'name': 'Nearest Strike 10 Minutes'},  # nearest, 10 min
+            {'driver': 'GV8',     'value': 0, 'uom': 56,  'name': 'Strikes 30 Minutes'},  # strike events, 30 min
+            {'driver': 'GV9',     'value': 0, 'uom': 83,  'name': 'Nearest Strike 30 Minutes'},  # nearest, 30 min
+            {'driver': 'GV10',    'value': 0, 'uom': 56,  'name': 'Strikes 60 Minutes'},  # strike events, 60 min
+            {'driver': 'GV11',    'value': 0, 'uom': 83,  'name': 'Nearest Strike 60 Minutes'},  # nearest, 60 min
+            {'driver': 'GV12',    'value': -1, 'uom': 45, 'name': 'Minutes Since Strike'},  # -1 until the first strike
 
             ]
     units = {}
+    source_driver = 'GV5'
+    strike_drivers = ('GV6', 'GV7', 'GV8', 'GV9', 'GV10', 'GV11', 'GV12')
 
     def __init__(self, polyglot, primary, address, name):
         super(AirNode, self).__init__(polyglot, primary, address, name)
 
         self.elevation = 0  # needed for pressure conversion
-        self.trend = []
+        self.metrics = derived.DerivedEngine(self.elevation)
+        self.trend = derived.PressureTrend()
         self.windspeed = 0  
 
+    def SetElevation(self, elevation):
+        self.elevation = elevation
+        self.metrics = derived.DerivedEngine(elevation)
+
     def update(self, obs, force):
         # process air data
         try:
@@ -48,14 +65,17 @@ class AirNode(udi_interface.Node):
             ld = obs[0][5] # distance
             bv = obs[0][6] # battery
 
-            sl = derived.toSeaLevel(p, self.elevation)
-            trend = derived.updateTrend(p, self.trend)
-            
+            trend = self.trend.update(tm, p)
+
             try:
-                fl = derived.ApparentTemp(t, self.windspeed/3.6, h)
-                dp = derived.Dewpoint(t, h)
-                hi = derived.Heatindex(t, h)
-                wc = derived.Windchill(t, self.windspeed)
+                m = self.metrics.compute(t, h, self.windspeed, p)
+                sl = m.sealevel
+                fl = m.feels_like
+                dp = m.dewpoint
+                hi = m.heatindex
+                wc = m.windchill
+                wb = m.wetbulb
+                ad = m.density
             except Exception as e:
                 LOGGER.error('Failure to calculate Air temps: ' + str(e))
 
@@ -71,6 +91,7 @@ class AirNode(udi_interface.Node):
             dp = round((dp * 1.8) + 32, 2)  # convert to F
             hi = round((hi * 1.8) + 32, 2)  # convert to F
             wc = round((wc * 1.8) + 32, 2)  # convert to F
+            wb = round((wb * 1.8) + 32, 2)  # convert to F
             uom = 17
         else:
             uom = 4
@@ -79,6 +100,7 @@ class AirNode(udi_interface.Node):
         self.setDriver('DEWPT', dp, uom=uom)
         self.setDriver('HEATIX', hi, uom=uom)
         self.setDriver('WINDCH', wc, uom=uom)
+        self.setDriver('GV3', wb, uom=uom)
 
         # pressures p, sl  (conversions)
         if self.units['pressure'] == 'inhg':
@@ -106,4 +128,5 @@ class AirNode(udi_interface.Node):
         self.setDriver('BATLVL', bv)
         self.setDriver('GV1', trend)
         self.setDriver('GV2', ls)
+        self.setDriver('GV4', ad)
 
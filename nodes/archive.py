@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+On disk archive of observations.
+
+Raw observations are kept for a short time and compacted into 5 minute,
+hourly and daily rollups (min, max, sum and count of each field) that
+are kept much longer.  Range queries are answered from the largest
+rollups that fit inside the range, with the finer tiers used only for
+the edges, so "rain this month" reads a handful of rows.  Rollup
+buckets are aligned to UTC.
+
+All writes happen on one background thread.  Compaction and pruning
+are done a little at a time on that thread so the I/O per pass is
+bounded.
+
+Observations can arrive late (REST polling, WebSocket catch up, the
+switch from UDP to REST), so buckets are only compacted once they are
+GRACE seconds old.  Anything that still arrives after its bucket was
+compacted has its buckets rolled up again on the next pass.
+"""
+import queue
+import sqlite3
+import threading
+import time
+import udi_interface
+from nodes import history
+
+LOGGER = udi_interface.LOGGER
+
+FIELDS = history.FIELDS
+
+# (table, bucket size in seconds, retention in seconds), finest first.
+# A retention of None means keep forever.
+TIERS = (
+        ('raw', 60, 7 * 86400),
+        ('rollup_5m', 300, 90 * 86400),
+        ('rollup_1h', 3600, 2 * 365 * 86400),
+        ('rollup_1d', 86400, None),
+        )
+
+COMPACT_INTERVAL = 60    # seconds between compaction passes
+COMPACT_BUCKETS = 288    # most buckets compacted per tier per pass
+PRUNE_ROWS = 5000        # most rows deleted per tier per pass
+GRACE = 900              # seconds a bucket stays open for late observations
+
+
+class Archive(object):
+    def __init__(self, path='archive.db'):
+        self.path = path
+        self.queue = queue.Queue()
+        self.local = threading.local()
+        self.thread = None
+        self.stopping = False
+        self.watermark = {}
+        self.late = None        # oldest observation written after it was compacted
+
+        db = self._db()
+        db.execute('PRAGMA journal_mode=WAL')
+        raw_cols = ', '.join('{} REAL'.format(f) for f in FIELDS)
+        db.execute('CREATE TABLE IF NOT EXISTS raw (device INTEGER, ts INTEGER, {}, PRIMARY KEY (device, ts))'.format(raw_cols))
+        rollup_cols = ', '.join('{0}_min REAL, {0}_max REAL, {0}_sum REAL, {0}_n INTEGER'.format(f) for f in FIELDS)
+        for (table, size, keep) in TIERS[1:]:
+            db.execute('CREATE TABLE IF NOT EXISTS {} (device INTEGER, ts INTEGER, {}, PRIMARY KEY (device, ts))'.format(table, rollup_cols))
+        db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        db.commit()
+
+        for (table, size, keep) in TIERS[1:]:
+            row = db.execute('SELECT value FROM meta WHERE name = ?', (table,)).fetchone()
+            self.watermark[table] = row[0] if row is not None else 0
+
+    def _db(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self.local, 'db'):
+            self.local.db = sqlite3.connect(self.path, timeout=30)
+        return self.local.db
+
+    def start(self):
+        self.thread = threading.Thread(target=self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Write what's queued and stop the writer """
+        self.stopping = True
+        self.queue.put(None)
+        if self.thread is not None:
+            self.thread.join(10)
+
+    def add(self, device_id, obs):
+        """ Queue an Observation to be written """
+        self.queue.put((int(device_id), obs))
+
+    def _writer(self):
+        db = self._db()
+        next_compact = time.time() + COMPACT_INTERVAL
+        insert = 'INSERT OR REPLACE INTO raw (device, ts, {}) VALUES ({})'.format(
+                ', '.join(FIELDS), ', '.join(['?'] * (len(FIELDS) + 2)))
+
+        done = False
+        while not done:
+            try:
+                item = self.queue.get(timeout=max(next_compact - time.time(), 0.1))
+            except queue.Empty:
+                item = False
+
+            rows = []
+            while item is not False:
+                if item is None:
+                    # stop() was called, write what's left and finish
+                    done = True
+                    break
+                (device_id, o) = item
+                rows.append([device_id, o.timestamp] + [getattr(o, f) for f in FIELDS])
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            if rows:
+                try:
+                    db.executemany(insert, rows)
+                    db.commit()
+                    self.mark_late(min(r[1] for r in rows))
+                except Exception as e:
+                    LOGGER.error('Failed to write {} observations to archive: {}'.format(len(rows), e))
+
+            if not done and time.time() >= next_compact:
+                try:
+                    self.compact()
+                except Exception as e:
+                    LOGGER.error('Archive compaction failed: {}'.format(e))
+                next_compact = time.time() + COMPACT_INTERVAL
+
+        db.close()
+
+    def mark_late(self, ts):
+        """ Note raw rows written for a bucket that was already compacted """
+        if ts < self.watermark[TIERS[1][0]] and (self.late is None or ts < self.late):
+            self.late = ts
+
+    def _rollup(self, db, level, start, end):
+        """ (Re)build tier level's buckets from start to end from the tier below """
+        (src, src_size, src_keep) = TIERS[level - 1]
+        (table, size, keep) = TIERS[level]
+        if src == 'raw':
+            aggs = ', '.join('MIN({0}), MAX({0}), SUM({0}), COUNT({0})'.format(f) for f in FIELDS)
+        else:
+            aggs = ', '.join('MIN({0}_min), MAX({0}_max), SUM({0}_sum), SUM({0}_n)'.format(f) for f in FIELDS)
+        cols = ', '.join('{0}_min, {0}_max, {0}_sum, {0}_n'.format(f) for f in FIELDS)
+
+        db.execute('INSERT OR REPLACE INTO {0} (device, ts, {1}) '
+                   'SELECT device, (ts / {2}) * {2}, {3} FROM {4} '
+                   'WHERE ts >= ? AND ts < ? GROUP BY device, ts / {2}'.format(
+                       table, cols, size, aggs, src), (start, end))
+
+    def recompact(self, now):
+        """ Roll up again the buckets that got late observations """
+        late, self.late = self.late, None
+        if late is None:
+            return
+        if late < now - TIERS[0][2] + GRACE:
+            # The rest of the raw rows for these buckets are being pruned
+            LOGGER.warning('Observations from {} arrived too late for the archive rollups'.format(late))
+            return
+
+        db = self._db()
+        for level in range(1, len(TIERS)):
+            (table, size, keep) = TIERS[level]
+            start = (late // size) * size
+            if start < self.watermark[table]:
+                self._rollup(db, level, start, self.watermark[table])
+        db.commit()
+
+    def compact(self, now=None):
+        """ One bounded pass of compaction and pruning for each tier """
+        db = self._db()
+        if now is None:
+            now = int(time.time())
+
+        self.recompact(now)
+
+        for level in range(1, len(TIERS)):
+            (src, src_size, src_keep) = TIERS[level - 1]
+            (table, size, keep) = TIERS[level]
+
+            start = self.watermark[table]
+            if start == 0:
+                row = db.execute('SELECT MIN(ts) FROM {}'.format(src)).fetchone()
+                if row[0] is None:
+                    continue
+                start = (row[0] // size) * size
+
+            # only complete buckets that are past the grace period, and
+            # only a limited number of them
+            end = min(((now - GRACE) // size) * size, start + (COMPACT_BUCKETS * size))
+            if level > 1:
+                end = min(end, self.watermark[src])
+            if end <= start:
+                continue
+
+            self._rollup(db, level, start, end)
+            db.execute('INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)', (table, end))
+            db.commit()
+            self.watermark[table] = end
+
+        for (table, size, keep) in TIERS:
+            if keep is None:
+                continue
+            # Never prune rows that haven't been compacted yet
+            limit = now - keep
+            for (t, s, k) in TIERS:
+                if t != 'raw' and s > size:
+                    limit = min(limit, self.watermark[t])
+                    break
+            db.execute('DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0} WHERE ts < ? LIMIT {1})'.format(table, PRUNE_ROWS), (limit,))
+            db.commit()
+
+    def _plan(self, start, end, level):
+        """
+          Split [start, end) into (table, start, end) pieces, using the
+          coarsest tier for as much of the range as possible.
+        """
+        if start >= end:
+            return []
+        if level == 0:
+            return [('raw', start, end)]
+
+        (table, size, keep) = TIERS[level]
+        a = -(-start // size) * size
+        b = min((end // size) * size, self.watermark[table])
+        if a >= b:
+            return self._plan(start, end, level - 1)
+        return self._plan(start, a, level - 1) + [(table, a, b)] + self._plan(b, end, level - 1)
+
+    def query(self, device_id, field, start, end):
+        """
+          Return a dictionary with the min, max, sum, count and mean of
+          field from start to end (epoch seconds).
+        """
+        if field not in FIELDS:
+            raise ValueError('Unknown field {}'.format(field))
+
+        db = self._db()
+        result = {'min': None, 'max': None, 'sum': 0, 'count': 0, 'mean': None}
+
+        for (table, a, b) in self._plan(int(start), int(end), len(TIERS) - 1):
+            if table == 'raw':
+                sql = 'SELECT MIN({0}), MAX({0}), SUM({0}), COUNT({0}) FROM raw'.format(field)
+            else:
+                sql = 'SELECT MIN({0}_min), MAX({0}_max), SUM({0}_sum), SUM({0}_n) FROM {1}'.format(field, table)
+            row = db.execute(sql + ' WHERE device = ? AND ts >= ? AND ts < ?', (int(device_id), a, b)).fetchone()
+
+            if row[3]:
+                result['min'] = row[0] if result['min'] is None else min(result['min'], row[0])
+                result['max'] = row[1] if result['max'] is None else max(result['max'], row[1])
+                result['sum'] += row[2]
+                result['count'] += row[3]
+
+        if result['count'] > 0:
+            result['mean'] = result['sum'] / result['count']
+        return result
+
+    def rollups(self, device_id, table, start, end):
+        """ Return the rows of one rollup table as dictionaries """
+        if table not in [t[0] for t in TIERS[1:]]:
+            raise ValueError('Unknown rollup table {}'.format(table))
+
+        db = self._db()
+        cols = ['ts'] + ['{}_{}'.format(f, a) for f in FIELDS for a in ('min', 'max', 'sum', 'n')]
+        rows = db.execute('SELECT {} FROM {} WHERE device = ? AND ts >= ? AND ts < ? ORDER BY ts'.format(
+            ', '.join(cols), table), (int(device_id), int(start), int(end))).fetchall()
+        return [dict(zip(cols, r)) for r in rows]
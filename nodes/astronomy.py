@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Sun position values that only depend on the day of the year and the
+latitude.
+
+table(latitude) returns a table with a value for every day of the year
+(indexed by day of the year, 1 - 366) that is calculated once and then
+shared by everything using that latitude.  Formulas are from FAO-56.
+"""
+import array
+import functools
+import math
+
+DAYS = 367      # index 0 is unused so the day of the year is the index
+SOLAR_CONSTANT = 0.0820     # MJ m-2 min-1
+
+
+def relative_earth_sun_distance(julian_day):
+    return 1 + 0.033 * math.cos(((2 * math.pi) / 365) * julian_day)
+
+def solar_declination(julian_day):
+    return 0.409 * math.sin(((2 * math.pi) / 365) * julian_day - 1.39)
+
+def equation_of_time(julian_day):
+    """ Seasonal correction for solar time, hours """
+    b = 2 * math.pi * (julian_day - 81) / 364
+    return 0.1645 * math.sin(2 * b) - 0.1255 * math.cos(b) - 0.025 * math.sin(b)
+
+
+class AstronomyTable(object):
+    """
+      Per day values for one latitude:
+        declination      radians
+        dr               inverse relative earth-sun distance
+        ws               sunset hour angle, radians
+        ra               extraterrestrial radiation, MJ/m2/day
+        sunrise, sunset  local solar time, hours
+        day_length       hours
+    """
+    def __init__(self, latitude):
+        self.latitude = latitude
+        lat = math.radians(latitude)
+
+        self.declination = array.array('d', [0.0] * DAYS)
+        self.dr = array.array('d', [0.0] * DAYS)
+        self.ws = array.array('d', [0.0] * DAYS)
+        self.ra = array.array('d', [0.0] * DAYS)
+        self.sunrise = array.array('d', [0.0] * DAYS)
+        self.sunset = array.array('d', [0.0] * DAYS)
+        self.day_length = array.array('d', [0.0] * DAYS)
+        self.eot = array.array('d', [0.0] * DAYS)
+
+        for day in range(DAYS):
+            dec = solar_declination(day)
+            dr = relative_earth_sun_distance(day)
+            # clamp for polar day and night
+            ws = math.acos(min(max(-math.tan(lat) * math.tan(dec), -1.0), 1.0))
+            ra = (24 * 60 / math.pi) * SOLAR_CONSTANT * dr * \
+                ((ws * math.sin(lat) * math.sin(dec)) + (math.cos(lat) * math.cos(dec) * math.sin(ws)))
+
+            self.declination[day] = dec
+            self.dr[day] = dr
+            self.ws[day] = ws
+            self.ra[day] = max(ra, 0.0)
+            self.day_length[day] = 24 / math.pi * ws
+            self.sunrise[day] = 12 - self.day_length[day] / 2
+            self.sunset[day] = 12 + self.day_length[day] / 2
+            self.eot[day] = equation_of_time(day)
+
+    def solar_to_utc(self, hours, julian_day, longitude):
+        """
+          Convert a local solar time (hours) to hours after midnight
+          UTC.  longitude is in degrees east.
+        """
+        return (hours - longitude / 15 - self.eot[julian_day]) % 24
+
+    def sun(self, julian_day, longitude):
+        """ (sunrise, sunset) as hours after midnight UTC """
+        return (self.solar_to_utc(self.sunrise[julian_day], julian_day, longitude),
+                self.solar_to_utc(self.sunset[julian_day], julian_day, longitude))
+
+
+@functools.lru_cache(maxsize=16)
+def table(latitude):
+    """ AstronomyTable for latitude (degrees), shared by all callers """
+    return AstronomyTable(round(latitude, 4))
+
+
+if __name__ == '__main__':
+    import time
+
+    # FAO-56 example 8: 20 S on 3 September, Ra = 32.2 MJ/m2/day
+    t = table(-20)
+    print('Ra {:.1f} (FAO-56 32.2) ws {:.3f} (FAO-56 1.527) N {:.1f} (FAO-56 11.7)'.format(
+        t.ra[246], t.ws[246], t.day_length[246]))
+
+    start = time.time()
+    table.cache_clear()
+    for i in range(100):
+        AstronomyTable(36.82)
+    print('building a table takes {:.2f} ms'.format((time.time() - start) * 10))
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Columnar history files.
+
+Each device gets a directory with one file per field.  Every file is a
+fixed width array of values (int64 timestamps, doubles for the rain
+fields and floats for everything else) that is memory mapped, so a range query is a binary search on
+the timestamp column and a sum over a slice of another column.  Nothing
+has to be parsed.
+
+The timestamp file starts with a count of the rows that have been
+completely written and the time the history is complete from.  A writer fills in every column for the new
+rows and only then updates the count, so readers never see a partial
+row.  Readers take a snapshot of the mapped columns and the count and
+work from that, they don't need the lock.
+"""
+import bisect
+import math
+import mmap
+import os
+import struct
+import threading
+import udi_interface
+from nodes import history
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+LOGGER = udi_interface.LOGGER
+
+FIELDS = history.FIELDS
+HEADER = 16           # row count and origin at the start of the timestamp file
+GROW_ROWS = 16384     # rows added to the files each time they fill up
+
+TYPECODES = {'ts': 'q'}
+for f in FIELDS:
+    TYPECODES[f] = 'd' if f in history.DOUBLE_FIELDS else 'f'
+
+
+class ColumnStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        self.files = {}
+        for name in ('ts',) + FIELDS:
+            f = os.path.join(path, name + '.col')
+            if not os.path.exists(f):
+                with open(f, 'wb') as fp:
+                    if name == 'ts':
+                        fp.write(struct.pack('<qq', 0, 0))
+            self.files[name] = open(f, 'r+b')
+
+        self.files['ts'].seek(0)
+        count = struct.unpack('<qq', self.files['ts'].read(HEADER))[0]
+        self.snapshot = (0, 0, {})
+        self._map(max(count, 1), count)
+
+    def _map(self, capacity, count):
+        """ Make sure every file holds capacity rows and map them """
+        capacity = -(-capacity // GROW_ROWS) * GROW_ROWS
+        columns = {}
+        for name, fp in self.files.items():
+            size = capacity * struct.calcsize(TYPECODES[name]) + (HEADER if name == 'ts' else 0)
+            fp.seek(0, os.SEEK_END)
+            if fp.tell() < size:
+                fp.truncate(size)
+            mm = mmap.mmap(fp.fileno(), size)
+            view = memoryview(mm)
+            if name == 'ts':
+                self.header = view[:HEADER]
+                view = view[HEADER:]
+            columns[name] = view.cast(TYPECODES[name])
+
+        # Readers holding the old snapshot keep using the old maps
+        self.snapshot = (count, capacity, columns)
+
+    def __len__(self):
+        return self.snapshot[0]
+
+    def first(self):
+        count, capacity, columns = self.snapshot
+        return columns['ts'][0] if count > 0 else None
+
+    def last(self):
+        count, capacity, columns = self.snapshot
+        return columns['ts'][count - 1] if count > 0 else None
+
+    def append(self, observations):
+        """
+          Append a list of Observations in time order.  Anything at or
+          before the newest stored timestamp is skipped.  Returns the
+          number of rows added.
+        """
+        with self.lock:
+            count, capacity, columns = self.snapshot
+            if count + len(observations) > capacity:
+                self._map(count + len(observations), count)
+                count, capacity, columns = self.snapshot
+
+            last = columns['ts'][count - 1] if count > 0 else None
+            added = 0
+            for o in observations:
+                if last is not None and o.timestamp <= last:
+                    continue
+                row = count + added
+                for f in FIELDS:
+                    v = getattr(o, f)
+                    columns[f][row] = math.nan if v is None else v
+                columns['ts'][row] = o.timestamp
+                last = o.timestamp
+                added += 1
+
+            if added:
+                self._commit(count + added)
+            return added
+
+    def _commit(self, count):
+        self.header[0:8] = struct.pack('<q', count)
+        c, capacity, columns = self.snapshot
+        self.snapshot = (count, capacity, columns)
+
+    def origin(self):
+        """ Time the stored history is complete from, 0 if unknown """
+        return struct.unpack('<q', self.header[8:16])[0]
+
+    def clear(self, origin=0):
+        """ Forget everything stored.  The files keep their size. """
+        with self.lock:
+            self._commit(0)
+            self.header[8:16] = struct.pack('<q', int(origin))
+
+    def flush(self):
+        count, capacity, columns = self.snapshot
+        for view in columns.values():
+            view.obj.flush()
+
+    def _range(self, start, end):
+        """ Snapshot and row slice for start <= ts < end """
+        count, capacity, columns = self.snapshot
+        if count == 0:
+            return columns, 0, 0
+        ts = columns['ts'][:count]
+        return columns, bisect.bisect_left(ts, start), bisect.bisect_left(ts, end)
+
+    def values(self, field, start, end):
+        """ Return the values of field from start to end (epoch seconds) """
+        columns, a, b = self._range(int(start), int(end))
+        if np is not None:
+            return np.array(columns[field][a:b], dtype=np.float64)
+        return columns[field][a:b].tolist()
+
+    def sum(self, field, start, end):
+        columns, a, b = self._range(int(start), int(end))
+        if a >= b:
+            return 0.0
+        if np is not None:
+            return float(np.nansum(np.asarray(columns[field][a:b], dtype=np.float64)))
+        return math.fsum(v for v in columns[field][a:b] if v == v)
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.snapshot = (0, 0, {})
+            self.header = None
+            for fp in self.files.values():
+                fp.close()
+
+
+if __name__ == '__main__':
+    # Append a year of one minute data while another thread reads it
+    import shutil
+    import tempfile
+    import time
+
+    path = tempfile.mkdtemp()
+    store = ColumnStore(os.path.join(path, '1234'))
+    start = int(time.time()) - 365 * 86400
+    rows = 365 * 1440
+    errors = []
+
+    def reader():
+        while len(store) < rows:
+            n = len(store)
+            total = store.sum('rain', start, start + n * 60)
+            if abs(total - n * 0.01) > 1e-6:
+                errors.append((n, total))
+
+    t = threading.Thread(target=reader)
+    t.start()
+    begin = time.time()
+    batch = []
+    for i in range(rows):
+        o = history.Observation(start + i * 60)
+        o.rain = 0.01
+        o.temperature = 20.0
+        batch.append(o)
+        if len(batch) == 1440:
+            store.append(batch)
+            batch = []
+    t.join()
+    print('append {} rows {:.2f}s, reader errors {}'.format(rows, time.time() - begin, len(errors)))
+
+    begin = time.time()
+    for d in range(365):
+        store.sum('rain', start + d * 86400, start + (d + 30) * 86400)
+    print('365 thirty day rain sums {:.4f}s, year total {:.2f}'.format(time.time() - begin, store.sum('rain', start, start + 366 * 86400)))
+
+    store.close()
+    store = ColumnStore(os.path.join(path, '1234'))
+    print('reopened with {} rows, last {}'.format(len(store), store.last() - start))
+    store.close()
+    shutil.rmtree(path)
@@ -6,6 +6,7 @@ Copyright (c) 2018,2019,2021 Robert Paauwe
 Derived metrics formulas.
 """
 import math
+import array
 import udi_interface
 LOGGER = udi_interface.LOGGER
 
@@ -85,39 +86,269 @@ def toSeaLevel(station, elevation):
 
     return slp
 
-# track pressures in a queue and calculate trend
-def updateTrend(current, mytrend):
-    t = 1  # Steady
-    past = 0
-
-    if len(mytrend) > 1:
-        LOGGER.info('LAST entry = %f' % mytrend[-1])
-    if len(mytrend) == 180:
-        # This should be poping the last entry on the list (or the 
-        # oldest item added to the list).
-        past = mytrend.pop()
-
-    if mytrend != []:
-        # mytrend[0] seems to be the last entry inserted, not
-        # the first.  So how do we get the last item from the
-        # end of the array -- mytrend[-1]
-        past = mytrend[-1]
-
-    # calculate trend
-    try:
-        LOGGER.info('TREND %f to %f' % (past, current))
-        if ((past - current) > 1):
-            t = 0 # Falling
-        elif ((past - current) < -1):
-            t = 2 # Rising
-
-        # inserts the value at index 0 and bumps all existing entries
-        # up by one index
-        mytrend.insert(0, current)
-    except:
-        LOGGER.error('Pressure value invalid. Trend not calculated.')
+class Metrics(object):
+    """ Derived values calculated from a single observation """
+    __slots__ = ('feels_like', 'dewpoint', 'heatindex', 'windchill',
+                 'sealevel', 'wetbulb', 'density')
+
+    def __init__(self):
+        self.feels_like = 0
+        self.dewpoint = 0
+        self.heatindex = 0
+        self.windchill = 0
+        self.sealevel = 0
+        self.wetbulb = 0
+        self.density = 0
+
+
+class DerivedEngine(object):
+    """
+      Calculate all the derived temperature and pressure values in
+      one pass.  This produces the same values as the individual
+      functions above but shares the intermediate values between them
+      and does the constant and per-station math once, when the engine
+      is created.
+    """
+    # Heat index coefficients
+    HI_C1 = -42.379
+    HI_C2 = 2.04901523
+    HI_C3 = 10.1433127
+    HI_C4 = -0.22475541
+    HI_C5 = -6.83783e-3
+    HI_C6 = -5.481717e-2
+    HI_C7 = 1.22874e-3
+    HI_C8 = 8.5282e-4
+    HI_C9 = -1.99e-6
+
+    # Gas constants for dry air and water vapor, J/(kg K)
+    RD = 287.05
+    RV = 461.495
+
+    def __init__(self, elevation=0):
+        i = 287.05  # gas constant for dry air
+        a = 9.80665 # gravity
+        r = 0.0065  # standard atmosphere lapse rate
+        s = 1013.35 # pressure at sealevel
+        n = 288.15  # sea level temperature
+
+        self.elevation = elevation * 1.0
+        # toSeaLevel() terms that only depend on the station elevation
+        self.sl_l = a / (i * r)
+        self.sl_c = i * r / a
+        self.sl_k = math.pow(s, self.sl_c) * (r * self.elevation / n)
+
+    def sea_level(self, station):
+        if station is None:
+            return 0
+
+        try:
+            st = station * 1.0
+            u = math.pow(1 + self.sl_k * math.pow(st, -self.sl_c), self.sl_l)
+            return round(st * u, 3)
+        except Exception as e:
+            LOGGER.error('Pressure conversion failed: ' + str(e))
+            return station
+
+    def compute(self, t, h, ws, p):
+        """
+          t = temperature in C, h = relative humidity in %,
+          ws = wind speed in kph, p = station pressure in mb
+        """
+        m = Metrics()
+        rh = h / 100.0
+        tf = (t * 1.8) + 32
+
+        # saturation vapor pressure (hPa), shared by feels like and
+        # air density
+        es = 6.105 * math.exp(17.27 * t / (237.7 + t))
+        e = rh * es
+
+        # feels like
+        m.feels_like = round(t + (0.33 * e) - (0.70 * (ws / 3.6)) - 4.0, 1)
+
+        # dewpoint
+        if rh <= 0:
+            m.dewpoint = 0
+        else:
+            b = (17.625 * t) / (243.04 + t)
+            c = math.log(rh)
+            m.dewpoint = round((243.04 * (c + b)) / (17.625 - c - b), 1)
+
+        # heat index
+        if (tf < 80.0) or (h < 40.0):
+            m.heatindex = t
+        else:
+            tf2 = tf * tf
+            h2 = h * h
+            hi = (self.HI_C1 + (self.HI_C2 * tf) + (self.HI_C3 * h) +
+                  (self.HI_C4 * tf * h) + (self.HI_C5 * tf2) +
+                  (self.HI_C6 * h2) + (self.HI_C7 * tf2 * h) +
+                  (self.HI_C8 * tf * h2) + (self.HI_C9 * tf2 * h2))
+            m.heatindex = round((hi - 32) / 1.8, 1)
+
+        # windchill
+        mph = ws / 1.609  # from kph to mph
+        if (tf <= 50.0) and (mph >= 5.0):
+            v = math.pow(mph, 0.16)
+            wc = 35.74 + (0.6215 * tf) - (35.75 * v) + (0.4275 * tf * v)
+            m.windchill = round((wc - 32) / 1.8, 1)
+        else:
+            m.windchill = t
+
+        # wet bulb temperature (Stull 2011)
+        m.wetbulb = round(t * math.atan(0.151977 * math.sqrt(h + 8.313659)) +
+                          math.atan(t + h) - math.atan(h - 1.676331) +
+                          0.00391838 * math.pow(h, 1.5) * math.atan(0.023101 * h) -
+                          4.686035, 1)
+
+        # sea level pressure and air density (kg/m3)
+        m.sealevel = self.sea_level(p)
+        if p is not None:
+            tk = t + 273.15
+            pv = e * 100.0
+            pd = (p * 100.0) - pv
+            m.density = round((pd / (self.RD * tk)) + (pv / (self.RV * tk)), 4)
+
+        return m
+
+
+class PressureTrend(object):
+    """
+      Track station pressure over time and calculate the trend.
+
+      Samples are stored in a fixed size ring indexed by observation
+      time (one slot per resolution seconds) so that it works the same
+      if observations arrive every minute over UDP or less often from
+      the REST server.  Running sums over the samples in the window
+      give a least-squares slope without walking the buffer.
+    """
+    def __init__(self, hours=6, resolution=60, tolerance=900):
+        self.resolution = resolution
+        self.tolerance = tolerance // resolution
+        self.size = (hours * 3600) // resolution
+        self.times = array.array('q', [0] * self.size)
+        self.values = array.array('d', [0.0] * self.size)
+        self.last = None  # slot index of the newest sample
+        self.origin = 0
+        self.reset_sums()
+
+    def reset_sums(self):
+        self.n = 0
+        self.sx = 0.0
+        self.sy = 0.0
+        self.sxy = 0.0
+        self.sxx = 0.0
+
+    def _add(self, ts, value, sign):
+        # x is in hours relative to origin to keep the sums well scaled
+        x = (ts - self.origin) / 3600.0
+        self.n += sign
+        self.sx += sign * x
+        self.sy += sign * value
+        self.sxy += sign * x * value
+        self.sxx += sign * x * x
+
+    def _clear(self, pos):
+        if self.times[pos] != 0:
+            self._add(self.times[pos], self.values[pos], -1)
+            self.times[pos] = 0
+
+    def _rebase(self, ts):
+        # Move the origin and rebuild the sums from the live samples.
+        # This only happens every few weeks.
+        self.origin = ts
+        self.reset_sums()
+        for pos in range(self.size):
+            if self.times[pos] != 0:
+                self._add(self.times[pos], self.values[pos], 1)
+
+    def add(self, ts, value):
+        if ts is None or value is None:
+            return
+
+        idx = int(ts) // self.resolution
+
+        if self.last is None:
+            self.origin = int(ts)
+            self.last = idx
+        elif idx > self.last:
+            # Slots between the previous sample and this one now hold
+            # samples that are older than the window.
+            for i in range(self.last + 1, self.last + 1 + min(idx - self.last, self.size)):
+                self._clear(i % self.size)
+            self.last = idx
+        elif idx <= self.last - self.size:
+            # Too old to fit in the window
+            return
+
+        pos = idx % self.size
+        self._clear(pos)
+        self.times[pos] = int(ts)
+        self.values[pos] = value
+        self._add(int(ts), value, 1)
+
+        if (ts - self.origin) > (1000 * 3600):
+            self._rebase(int(ts))
+
+    def ago(self, seconds, now=None):
+        """
+          Return the pressure from about 'seconds' ago, or None if
+          there is no sample close enough to that time.
+        """
+        if self.last is None:
+            return None
+        if now is None:
+            now = self.last * self.resolution
+        want = (int(now) - seconds) // self.resolution
+        if want <= self.last - self.size:
+            want = self.last - self.size + 1
+
+        # Look for the closest sample within the tolerance, starting
+        # at the requested slot.
+        for offset in range(self.tolerance + 1):
+            for idx in (want + offset, want - offset):
+                if idx > self.last or idx <= self.last - self.size:
+                    continue
+                pos = idx % self.size
+                if self.times[pos] != 0 and self.times[pos] // self.resolution == idx:
+                    return self.values[pos]
+        return None
+
+    def slope(self):
+        """ Least-squares slope of the samples in the window, per hour """
+        if self.n < 2:
+            return None
+        d = (self.n * self.sxx) - (self.sx * self.sx)
+        if d <= 0:
+            return None
+        return ((self.n * self.sxy) - (self.sx * self.sy)) / d
+
+    def update(self, ts, current, hours=3):
+        """
+          Add the current pressure and return the trend compared to
+          'hours' ago. 0 = falling, 1 = steady, 2 = rising
+        """
+        t = 1  # Steady
+
+        try:
+            self.add(ts, float(current))
+            past = self.ago(hours * 3600)
+            if past is not None:
+                change = current - past
+            else:
+                # Not enough history yet, use the fitted slope instead.
+                m = self.slope()
+                change = (m * hours) if m is not None else 0
+            LOGGER.debug('TREND change over {} hours = {}'.format(hours, change))
+
+            if change < -1:
+                t = 0 # Falling
+            elif change > 1:
+                t = 2 # Rising
+        except Exception as e:
+            LOGGER.error('Pressure value invalid. Trend not calculated. {}'.format(e))
 
-    return t
+        return t
 
 
 def hourly_accumulation(self, r):
@@ -169,4 +400,21 @@ def yearly_accumulation(self, r):
     self.yearly_rain += r
     return self.yearly_rain
 
-    
+
+if __name__ == '__main__':
+    # Check the engine against the individual functions
+    worst = 0
+    for elevation in (0, 150, 1600):
+        engine = DerivedEngine(elevation)
+        for t in range(-30, 46, 3):
+            for h in range(5, 101, 5):
+                for ws in (0, 4, 12, 30, 60):
+                    for p in (850.0, 960.5, 1013.2):
+                        m = engine.compute(t, h, ws, p)
+                        worst = max(worst,
+                            abs(m.feels_like - ApparentTemp(t, ws/3.6, h)),
+                            abs(m.dewpoint - Dewpoint(t, h)),
+                            abs(m.heatindex - Heatindex(t, h)),
+                            abs(m.windchill - Windchill(t, ws)),
+                            abs(m.sealevel - toSeaLevel(p, elevation)))
+    print('largest difference = ', worst)
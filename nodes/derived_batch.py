@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Derived metrics formulas for arrays of values.
+
+These match the functions in derived.py but take sequences (or NumPy
+arrays) so a whole day or year of history can be processed at once.
+NumPy is optional.  If it isn't installed, or the inputs are plain
+scalars, the values are calculated with the scalar functions.
+"""
+from nodes import derived
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _is_scalar(*values):
+    for v in values:
+        if isinstance(v, (list, tuple)) or (np is not None and isinstance(v, np.ndarray)):
+            return False
+    return True
+
+def _array(v):
+    # None (missing value) becomes NaN
+    return np.asarray(v, dtype=float)
+
+def _broadcast(*values):
+    # Used by the pure python fallback to pair up arrays and scalars
+    n = max(len(v) for v in values if isinstance(v, (list, tuple)))
+    return [v if isinstance(v, (list, tuple)) else [v] * n for v in values]
+
+def _fallback(func, *values):
+    return [func(*args) for args in zip(*_broadcast(*values))]
+
+
+def Dewpoint(t, h):
+    if _is_scalar(t, h):
+        return derived.Dewpoint(t, h)
+    if np is None:
+        return _fallback(derived.Dewpoint, t, h)
+
+    t = _array(t)
+    rh = _array(h) / 100.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        b = (17.625 * t) / (243.04 + t)
+        c = np.log(rh)
+        dewpt = (243.04 * (c + b)) / (17.625 - c - b)
+    return np.where(rh <= 0, 0.0, np.round(dewpt, 1))
+
+def ApparentTemp(t, ws, h):
+    """ ws is in m/s """
+    if _is_scalar(t, ws, h):
+        return derived.ApparentTemp(t, ws, h)
+    if np is None:
+        return _fallback(derived.ApparentTemp, t, ws, h)
+
+    t = _array(t)
+    wv = _array(h) / 100.0 * 6.105 * np.exp(17.27 * t / (237.7 + t))
+    return np.round(t + (0.33 * wv) - (0.70 * _array(ws)) - 4.0, 1)
+
+def Windchill(t, ws):
+    """ ws is in kph """
+    if _is_scalar(t, ws):
+        return derived.Windchill(t, ws)
+    if np is None:
+        return _fallback(derived.Windchill, t, ws)
+
+    t = _array(t)
+    tf = (t * 1.8) + 32
+    mph = _array(ws) / 1.609  # from kph to mph
+    v = np.power(mph, 0.16)
+    wc = 35.74 + (0.6215 * tf) - (35.75 * v) + (0.4275 * tf * v)
+
+    return np.where((tf <= 50.0) & (mph >= 5.0), np.round((wc - 32) / 1.8, 1), t)
+
+def Heatindex(t, h):
+    if _is_scalar(t, h):
+        return derived.Heatindex(t, h)
+    if np is None:
+        return _fallback(derived.Heatindex, t, h)
+
+    e = derived.DerivedEngine
+    t = _array(t)
+    h = _array(h)
+    tf = (t * 1.8) + 32
+    tf2 = tf * tf
+    h2 = h * h
+    hi = (e.HI_C1 + (e.HI_C2 * tf) + (e.HI_C3 * h) + (e.HI_C4 * tf * h) +
+          (e.HI_C5 * tf2) + (e.HI_C6 * h2) + (e.HI_C7 * tf2 * h) +
+          (e.HI_C8 * tf * h2) + (e.HI_C9 * tf2 * h2))
+
+    return np.where((tf < 80.0) | (h < 40.0), t, np.round((hi - 32) / 1.8, 1))
+
+def toSeaLevel(station, elevation):
+    """ elevation is a single value for the station """
+    if _is_scalar(station):
+        return derived.toSeaLevel(station, elevation)
+    if np is None:
+        return [derived.toSeaLevel(st, elevation) for st in station]
+
+    engine = derived.DerivedEngine(elevation)
+    st = _array(station)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        u = np.power(1 + engine.sl_k * np.power(st, -engine.sl_c), engine.sl_l)
+        slp = np.round(st * u, 3)
+    return np.where(np.isnan(st), 0.0, slp)
+
+
+if __name__ == '__main__':
+    # Compare the array versions with the scalar functions
+    import random
+    import time
+
+    count = 100000
+    t = [random.uniform(-30, 45) for i in range(count)]
+    h = [random.uniform(1, 100) for i in range(count)]
+    ws = [random.uniform(0, 60) for i in range(count)]
+    p = [random.uniform(850, 1040) for i in range(count)]
+
+    checks = (
+        ('Dewpoint', lambda: Dewpoint(t, h), lambda: [derived.Dewpoint(*a) for a in zip(t, h)]),
+        ('ApparentTemp', lambda: ApparentTemp(t, ws, h), lambda: [derived.ApparentTemp(*a) for a in zip(t, ws, h)]),
+        ('Windchill', lambda: Windchill(t, ws), lambda: [derived.Windchill(*a) for a in zip(t, ws)]),
+        ('Heatindex', lambda: Heatindex(t, h), lambda: [derived.Heatindex(*a) for a in zip(t, h)]),
+        ('toSeaLevel', lambda: toSeaLevel(p, 300), lambda: [derived.toSeaLevel(v, 300) for v in p]),
+        )
+
+    for name, batch, scalar in checks:
+        start = time.time()
+        b = batch()
+        batch_time = time.time() - start
+        start = time.time()
+        s = scalar()
+        scalar_time = time.time() - start
+        worst = max(abs(x - y) for x, y in zip(b, s))
+        print('{:14} largest difference {:.4f}  batch {:.3f}s  scalar {:.3f}s'.format(name, worst, batch_time, scalar_time))
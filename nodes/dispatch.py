@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Message dispatch.
+
+Maps the "type" field of a WeatherFlow message (obs_st, rapid_wind,
+evt_strike, ...) to the functions that handle it.  Anything that wants
+a message type registers a handler, the receive loop just calls
+dispatch() for every message.  Messages nobody registered for are
+ignored.
+
+The handler table is replaced, not modified, when handlers change so
+the receive loop never needs a lock.
+"""
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+
+class Dispatcher(object):
+    def __init__(self):
+        self.handlers = {}      # message type -> tuple of handlers
+
+    def register(self, msg_type, handler):
+        """ Add handler(data) for msg_type """
+        handlers = dict(self.handlers)
+        handlers[msg_type] = handlers.get(msg_type, ()) + (handler,)
+        self.handlers = handlers
+
+    def unregister(self, msg_type, handler=None):
+        """ Remove handler, or every handler if None, for msg_type """
+        handlers = dict(self.handlers)
+        if handler is None:
+            handlers.pop(msg_type, None)
+        else:
+            remaining = tuple(h for h in handlers.get(msg_type, ()) if h != handler)
+            if remaining:
+                handlers[msg_type] = remaining
+            else:
+                handlers.pop(msg_type, None)
+        self.handlers = handlers
+
+    def types(self):
+        return list(self.handlers.keys())
+
+    def dispatch(self, data):
+        """ Call the handlers for data's type.  Returns True if handled """
+        if not isinstance(data, dict):
+            return False
+        handlers = self.handlers.get(data.get('type'))
+        if handlers is None:
+            return False
+
+        for handler in handlers:
+            try:
+                handler(data)
+            except Exception as e:
+                LOGGER.error('Failed to handle {} message: {}'.format(data.get('type'), e))
+        return True
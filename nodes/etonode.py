@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Evapotranspiration for one station.
+"""
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+class EToNode(udi_interface.Node):
+    id = 'eto'
+    drivers = [
+            {'driver': 'ETO', 'value': 0, 'uom': 106, 'name': 'Yesterday\'s ETo'},
+            {'driver': 'GV0', 'value': 0, 'uom': 82, 'name': '7 Day ETo'},
+            ]
+
+    units = {}
+
+    def __init__(self, polyglot, primary, address, name):
+        super(EToNode, self).__init__(polyglot, primary, address, name)
+
+    def publish(self, eto, week):
+        # Values are in mm.  Convert to inches if rain is in inches
+        if self.units['rain'] == 'in':
+            self.setDriver('ETO', round(eto * 0.03937, 3), uom=120)
+            self.setDriver('GV0', round(week * 0.03937, 3), uom=105)
+        else:
+            self.setDriver('ETO', round(eto, 3), uom=106)
+            self.setDriver('GV0', round(week, 3), uom=82)
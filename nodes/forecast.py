@@ -2,101 +2,253 @@
 """
 Polyglot v3 node server for WeatherFlow Weather Station data.
 Copyright (c) 2018,2019,2020,2021 Robert Paauwe
+
+Forecast nodes.
+
+The forecast is converted into compact records once per fetch by
+parse_daily() and parse_hourly().  The nodes only compare the record
+with what they last sent and call setDriver for the values that changed.
+Days and times are in the forecast station's timezone, which isn't
+necessarily the one this machine is in.
 """
 import udi_interface
-import sys
-import time
 import datetime
-import json
-import math
-import threading
+import functools
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
 
 LOGGER = udi_interface.LOGGER
 
+# Conditions string to WEATHER value (see the nls file)
+CONDITIONS = {
+        'Clear': 0,
+        'Rain Likely': 1,
+        'Rain Possible': 2,
+        'Snow': 3,
+        'Snow Possible': 4,
+        'Wintry Mix Likely': 5,
+        'Wintry Mix Possible': 6,
+        'Thunderstorms Likely': 7,
+        'Thunderstorms Possible': 8,
+        'Windy': 9,
+        'Foggy': 10,
+        'Cloudy': 11,
+        'Partly Cloudy': 12,
+        'Very Light Rain': 13,
+        'Snow Likely': 14,
+        }
+CONDITIONS_UNKNOWN = 15
+
+# Icon name to FICON value
+ICONS = {
+        'clear-day': 0,
+        'clear-night': 1,
+        'cloudy': 2,
+        'foggy': 3,
+        'partly-cloudy-day': 4,
+        'partly-cloudy-night': 5,
+        'possibly-rainy-day': 6,
+        'possibly-rainy-night': 7,
+        'possibly-sleet-day': 8,
+        'possibly-sleet-night': 9,
+        'possibly-snow-day': 10,
+        'possibly-snow-night': 11,
+        'possibly-thunderstorm-day': 12,
+        'possibly-thunderstorm-night': 13,
+        'rainy': 14,
+        'sleet': 15,
+        'snow': 16,
+        'thunderstorm': 17,
+        'windy': 18,
+        }
+ICON_UNKNOWN = 19
+
+# Precipitation type to PTYPE value, 0 is none
+PRECIP_TYPES = {
+        'rain': 1,
+        'snow': 2,
+        'sleet': 3,
+        'storm': 4,
+        }
+
+
+def condition_code(conditions):
+    return CONDITIONS.get(conditions, CONDITIONS_UNKNOWN)
+
+def unit_plan(units):
+    """
+      How to convert forecast values (C and m/s) for the station's
+      units.  Returns {'temp': (scale, offset, uom), 'wind': (scale, uom)}.
+    """
+    if units.get('temperature') == 'f':
+        temp = (1.8, 32, 17)
+    else:
+        temp = (1, 0, 4)
+
+    if units.get('wind') == 'mph':
+        wind = (2.23694, 48)
+    elif units.get('wind') == 'kph':
+        wind = (3.6, 32)
+    else:
+        wind = (1, 40)
+
+    return {'temp': temp, 'wind': wind}
+
+@functools.lru_cache(maxsize=8)
+def _zone(timezone):
+    # None means the machine's local time
+    if timezone is None or ZoneInfo is None:
+        return None
+    try:
+        return ZoneInfo(timezone)
+    except Exception as e:
+        LOGGER.warning('Unknown timezone {}, using local time: {}'.format(timezone, e))
+        return None
+
+def _local(ts, timezone):
+    zone = _zone(timezone)
+    if zone is None:
+        return datetime.datetime.fromtimestamp(ts)
+    return datetime.datetime.fromtimestamp(ts, zone)
+
+@functools.lru_cache(maxsize=32)
+def _weekday(ts, timezone=None):
+    # ISY day of week, 0 = Sunday
+    return (_local(ts, timezone).weekday() + 1) % 7
+
+def _clock(ts, timezone=None):
+    # station time as HHMM
+    if ts is None:
+        return 0
+    t = _local(ts, timezone)
+    return t.hour * 100 + t.minute
+
+
+def parse_daily(daily, timezone=None):
+    """
+      Convert the forecast's daily array into (day of week, high, low,
+      pop, conditions, icon, precip type, sunrise, sunset) records.
+      Temperatures are C, days and times are in timezone (local time
+      if None).
+    """
+    records = []
+    for forecast in daily:
+        records.append((
+            _weekday(forecast['day_start_local'], timezone) if 'day_start_local' in forecast else 0,
+            forecast.get('air_temp_high', 0),
+            forecast.get('air_temp_low', 0),
+            forecast.get('precip_probability', 0),
+            condition_code(forecast.get('conditions')),
+            ICONS.get(forecast.get('icon'), ICON_UNKNOWN),
+            PRECIP_TYPES.get(forecast.get('precip_type'), 0),
+            _clock(forecast.get('sunrise'), timezone),
+            _clock(forecast.get('sunset'), timezone),
+            ))
+    return records
+
+def parse_hourly(hourly, count):
+    """
+      Convert the first count entries of the forecast's hourly array
+      into (hour, temperature, pop, wind speed, wind direction,
+      conditions) records.  Values are C and m/s.
+    """
+    records = []
+    for forecast in hourly[:count]:
+        records.append((
+            forecast.get('local_hour', 0),
+            forecast.get('air_temperature', 0),
+            forecast.get('precip_probability', 0),
+            forecast.get('wind_avg', 0),
+            forecast.get('wind_direction', 0),
+            condition_code(forecast.get('conditions')),
+            ))
+    return records
+
+
+def _publish(node, values, force):
+    # values is a tuple of (driver, value, uom).  Only send what changed.
+    for i, (driver, value, uom) in enumerate(values):
+        if force or node.last is None or node.last[i] != values[i]:
+            node.setDriver(driver, value, True, force, uom)
+    node.last = values
+
+
 class ForecastNode(udi_interface.Node):
     id = 'forecast'
-    units = 'metric'
     drivers = [
             {'driver': 'ST',   'value': 0, 'uom': 75, 'name': 'Day of Week'},   # day
             {'driver': 'GV0',  'value': 0, 'uom': 4,  'name': 'High Temperature'},   # high temp
             {'driver': 'GV1',  'value': 0, 'uom': 4,  'name': 'Low Temperature'},   # low temp
             {'driver': 'GV13', 'value': 0, 'uom': 25, 'name': 'Weather Conditions'}, # weather
             {'driver': 'POP',  'value': 0, 'uom': 51, 'name': 'Chance of Precipitation'}, # pop
+            {'driver': 'GV2',  'value': 0, 'uom': 25, 'name': 'Icon'},
+            {'driver': 'GV3',  'value': 0, 'uom': 25, 'name': 'Precipitation Type'},
+            {'driver': 'GV4',  'value': 0, 'uom': 56, 'name': 'Sunrise'},
+            {'driver': 'GV5',  'value': 0, 'uom': 56, 'name': 'Sunset'},
             ]
 
     def __init__(self, polyglot, primary, address, name):
         super(ForecastNode, self).__init__(polyglot, primary, address, name)
-        self.units = None
-
-
-    def SetUnits(self, u):
-        LOGGER.info('Setting forecast units to {}'.format(u))
-        self.units = u
-
-    def update(self, forecast, force=False):
-        """
-        {'day_start_local': 1613980800, 'day_num': 22, 'month_num': 2, 'conditions': 'Clear', 'icon': 'clear-day', 'sunrise': 1613918795, 'sunset': 1613958540, 'air_temp_high': 18.0, 'air_temp_low': 6.0, 'precip_probability': 10, 'precip_icon': 'chance-rain', 'precip_type': 'rain'}
-        """
-        if 'day_num' in forecast:
-            # 0 = monday (UOM should be 1)
-            # 1 = tuesday (UOM should be 2)
-            # 2 = wednesday (UOM should be 3)
-            # 3 = thursday (UOM should be 4)
-            # 4 = friday (UOM should be 5)
-            # 5 = saturday (UOM should be 6)
-            # 6 = sunday (UOM should be 0)
-            dt = datetime.date.fromtimestamp(forecast['day_start_local'])
-            self.setDriver('ST', ((dt.weekday() + 1) % 7), True, force, 75)
-        if 'air_temp_high' in forecast:
-            if self.units == 'f':
-                value = round((forecast['air_temp_high'] * 1.8) + 32, 1)  # convert to F
-                uom = 17
-            else:
-                value = forecast['air_temp_high']
-                uom = 4
-            self.setDriver('GV0', value, True, force, uom)
-        if 'air_temp_low' in forecast:
-            if self.units == 'f':
-                value = round((forecast['air_temp_low'] * 1.8) + 32, 1)  # convert to F
-                uom = 17
-            else:
-                value = forecast['air_temp_low']
-                uom = 4
-            self.setDriver('GV1', value, True, force, uom)
-        if 'precip_probability' in forecast:
-            self.setDriver('POP', forecast['precip_probability'], True, force, 51)
-        if 'conditions' in forecast:
-            # convert conditions string to value
-            if forecast['conditions'] == 'Clear':
-                condition_code = 0
-            elif forecast['conditions'] == 'Rain Likely':
-                condition_code = 1
-            elif forecast['conditions'] == 'Rain Possible':
-                condition_code = 2
-            elif forecast['conditions'] == 'Snow':
-                condition_code = 3
-            elif forecast['conditions'] == 'Snow Possible':
-                condition_code = 4
-            elif forecast['conditions'] == 'Wintry Mix Likely':
-                condition_code = 5
-            elif forecast['conditions'] == 'Wintry Mix Possible':
-                condition_code = 6
-            elif forecast['conditions'] == 'Thunderstorms Likely':
-                condition_code = 7
-            elif forecast['conditions'] == 'Thunderstorms Possible':
-                condition_code = 8
-            elif forecast['conditions'] == 'Windy':
-                condition_code = 9
-            elif forecast['conditions'] == 'Foggy':
-                condition_code = 10
-            elif forecast['conditions'] == 'Cloudy':
-                condition_code = 11
-            elif forecast['conditions'] == 'Partly Cloudy':
-                condition_code = 12
-            elif forecast['conditions'] == 'Very Light Rain':
-                condition_code = 13
-            else:
-                condition_code = 14
-
-            self.setDriver('GV13', condition_code, True, force, 25)
+        self.plan = unit_plan({})
+        self.last = None
+
+    def SetUnits(self, units):
+        LOGGER.info('Setting forecast units to {}'.format(units))
+        self.plan = unit_plan(units)
+        self.last = None
+
+    def update(self, record, force=False):
+        """ record is from parse_daily() """
+        (day, high, low, pop, conditions, icon, precip_type, sunrise, sunset) = record
+        (scale, offset, temp_uom) = self.plan['temp']
+
+        _publish(self, (
+                ('ST', day, 75),
+                ('GV0', round(high * scale + offset, 1), temp_uom),
+                ('GV1', round(low * scale + offset, 1), temp_uom),
+                ('GV13', conditions, 25),
+                ('POP', pop, 51),
+                ('GV2', icon, 25),
+                ('GV3', precip_type, 25),
+                ('GV4', sunrise, 56),
+                ('GV5', sunset, 56),
+                ), force)
+
+
+class HourlyForecastNode(udi_interface.Node):
+    id = 'hourly'
+    drivers = [
+            {'driver': 'ST',      'value': 0, 'uom': 56, 'name': 'Hour'},
+            {'driver': 'CLITEMP', 'value': 0, 'uom': 4,  'name': 'Temperature'},
+            {'driver': 'POP',     'value': 0, 'uom': 51, 'name': 'Chance of Precipitation'},
+            {'driver': 'SPEED',   'value': 0, 'uom': 40, 'name': 'Wind Speed'},
+            {'driver': 'WINDDIR', 'value': 0, 'uom': 76, 'name': 'Wind Direction'},
+            {'driver': 'GV13',    'value': 0, 'uom': 25, 'name': 'Weather Conditions'},
+            ]
+
+    def __init__(self, polyglot, primary, address, name):
+        super(HourlyForecastNode, self).__init__(polyglot, primary, address, name)
+        self.plan = unit_plan({})
+        self.last = None
+
+    def SetUnits(self, units):
+        self.plan = unit_plan(units)
+        self.last = None
+
+    def update(self, record, force=False):
+        """ record is from parse_hourly() """
+        (hour, temp, pop, ws, wd, conditions) = record
+        (scale, offset, temp_uom) = self.plan['temp']
+        (wind_scale, wind_uom) = self.plan['wind']
 
+        _publish(self, (
+                ('ST', hour, 56),
+                ('CLITEMP', round(temp * scale + offset, 1), temp_uom),
+                ('POP', pop, 51),
+                ('SPEED', round(ws * wind_scale, 2), wind_uom),
+                ('WINDDIR', wd, 76),
+                ('GV13', conditions, 25),
+                ), force)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+In memory history of observations for each device.
+"""
+import array
+import math
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+# Values we keep for every device type.  Anything a device doesn't
+# report is stored as NaN.
+FIELDS = (
+        'temperature',      # C
+        'humidity',         # %
+        'pressure',         # station pressure, mb
+        'wind_lull',        # m/s
+        'wind_avg',         # m/s
+        'wind_gust',        # m/s
+        'wind_dir',         # degrees
+        'rain',             # mm over the reporting interval
+        'rain_nc',          # nearcast mm (REST only)
+        'illuminance',      # lux
+        'uv',               # index
+        'solar_radiation',  # W/m2
+        'strike_count',
+        'strike_distance',  # km
+        'battery',          # volts
+        )
+
+# Accumulated values are summed over long windows so keep them as
+# doubles, everything else fits in a float.
+DOUBLE_FIELDS = ('rain', 'rain_nc')
+
+# Where each field is in the obs array for each device type
+OBS_INDEX = {
+        'ST': {'wind_lull': 1, 'wind_avg': 2, 'wind_gust': 3, 'wind_dir': 4,
+               'pressure': 6, 'temperature': 7, 'humidity': 8,
+               'illuminance': 9, 'uv': 10, 'solar_radiation': 11,
+               'rain': 12, 'strike_distance': 14, 'strike_count': 15,
+               'battery': 16, 'rain_nc': 19},
+        'AR': {'pressure': 1, 'temperature': 2, 'humidity': 3,
+               'strike_count': 4, 'strike_distance': 5, 'battery': 6},
+        'SK': {'illuminance': 1, 'uv': 2, 'rain': 3, 'wind_lull': 4,
+               'wind_avg': 5, 'wind_gust': 6, 'wind_dir': 7, 'battery': 8,
+               'solar_radiation': 10, 'rain_nc': 14},
+        }
+
+
+class Observation(object):
+    """ One decoded observation """
+    __slots__ = ('timestamp',) + FIELDS
+
+    def __init__(self, timestamp):
+        self.timestamp = timestamp
+        for f in FIELDS:
+            setattr(self, f, None)
+
+    def as_dict(self):
+        d = {'timestamp': self.timestamp}
+        for f in FIELDS:
+            d[f] = getattr(self, f)
+        return d
+
+
+def decode(device_type, ob):
+    """
+      Convert an obs array (UDP or REST) into an Observation. Returns
+      None for unknown device types.
+    """
+    if device_type not in OBS_INDEX:
+        return None
+
+    o = Observation(int(ob[0]))
+    for f, idx in OBS_INDEX[device_type].items():
+        if idx < len(ob):
+            setattr(o, f, ob[idx])
+    return o
+
+
+class DeviceHistory(object):
+    """
+      Fixed size ring of observations, one slot per resolution seconds,
+      indexed by observation time.  Each field is stored in its own
+      array so memory use is fixed when the object is created.
+    """
+    def __init__(self, hours=72, resolution=60):
+        self.resolution = resolution
+        self.size = (hours * 3600) // resolution
+        self.times = array.array('q', [0] * self.size)
+        self.columns = {}
+        for f in FIELDS:
+            typecode = 'd' if f in DOUBLE_FIELDS else 'f'
+            self.columns[f] = array.array(typecode, [math.nan] * self.size)
+        self.last = None  # slot index of the newest observation
+
+    def memory_usage(self):
+        total = self.times.itemsize * len(self.times)
+        for f in FIELDS:
+            total += self.columns[f].itemsize * len(self.columns[f])
+        return total
+
+    def _clear(self, pos):
+        self.times[pos] = 0
+        for f in FIELDS:
+            self.columns[f][pos] = math.nan
+
+    def append(self, obs):
+        """ Add an Observation """
+        idx = obs.timestamp // self.resolution
+
+        if self.last is None:
+            self.last = idx
+        elif idx > self.last:
+            # Anything in the slots we skipped over is now too old
+            for i in range(self.last + 1, self.last + min(idx - self.last, self.size)):
+                self._clear(i % self.size)
+            self.last = idx
+        elif idx <= self.last - self.size:
+            return
+
+        pos = idx % self.size
+        self.times[pos] = obs.timestamp
+        for f in FIELDS:
+            v = getattr(obs, f)
+            self.columns[f][pos] = math.nan if v is None else v
+
+    def add(self, device_type, obs_list):
+        """ Decode and add a list of obs arrays """
+        for ob in obs_list:
+            try:
+                o = decode(device_type, ob)
+                if o is not None:
+                    self.append(o)
+            except Exception as e:
+                LOGGER.debug('Skipping observation for history: {}'.format(e))
+
+    def newest(self):
+        if self.last is None:
+            return None
+        return self.get(self.last * self.resolution)
+
+    def get(self, ts):
+        """ Return the Observation stored for time ts or None """
+        if self.last is None:
+            return None
+        idx = int(ts) // self.resolution
+        if idx > self.last or idx <= self.last - self.size:
+            return None
+        pos = idx % self.size
+        if self.times[pos] // self.resolution != idx or self.times[pos] == 0:
+            return None
+        o = Observation(self.times[pos])
+        for f in FIELDS:
+            v = self.columns[f][pos]
+            setattr(o, f, None if math.isnan(v) else v)
+        return o
+
+    def values(self, field, start, end):
+        """ Yield (timestamp, value) for field from start to end """
+        if self.last is None:
+            return
+        column = self.columns[field]
+        first = max(int(start) // self.resolution, self.last - self.size + 1)
+        last = min(int(end) // self.resolution, self.last)
+        for idx in range(first, last + 1):
+            pos = idx % self.size
+            ts = self.times[pos]
+            if ts == 0 or ts // self.resolution != idx or ts < start or ts > end:
+                continue
+            v = column[pos]
+            if not math.isnan(v):
+                yield ts, v
+
+    def min(self, field, start, end):
+        return min((v for t, v in self.values(field, start, end)), default=None)
+
+    def max(self, field, start, end):
+        return max((v for t, v in self.values(field, start, end)), default=None)
+
+    def sum(self, field, start, end):
+        return sum(v for t, v in self.values(field, start, end))
+
+    def mean(self, field, start, end):
+        n = 0
+        total = 0.0
+        for t, v in self.values(field, start, end):
+            n += 1
+            total += v
+        return (total / n) if n > 0 else None
+
+
+if __name__ == '__main__':
+    # Memory budget for a 10 device install with 72 hours of history
+    import time
+
+    budget = 4 * 1024 * 1024
+    devices = [DeviceHistory(72) for d in range(10)]
+    total = sum(d.memory_usage() for d in devices)
+    print('10 devices use {} bytes, budget {} bytes'.format(total, budget))
+    assert total < budget
+
+    # Fill one device with more than it can hold and check a window
+    now = int(time.time())
+    h = devices[0]
+    for i in range(5000):
+        ts = now - (5000 - i) * 60
+        h.add('ST', [[ts, 0.1, 1.0, 2.0, 90, 3, 1000, 20 + (i % 10), 50, 1000, 1, 100, 0.01, 0, 0, 0, 2.6, 1]])
+    print('last hour: min {} max {} mean {} rain {}'.format(
+        h.min('temperature', now - 3600, now), h.max('temperature', now - 3600, now),
+        h.mean('temperature', now - 3600, now), h.sum('rain', now - 3600, now)))
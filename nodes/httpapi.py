@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Read only HTTP API.
+
+Serves the node server's data as JSON so other programs on the local
+network can read it without going through the ISY.  Everything comes
+from the controller's in memory history and the archive.
+
+  /devices                      devices we know about
+  /eto                          ETo so far today for each station (mm)
+  /current/<device>             newest observation
+  /stats/<device>?minutes=60    min, max, mean and sum of each field
+  /wind/<device>                2 and 10 minute wind and the peak gust
+  /summary/<device>?field=rain&start=<epoch>&end=<epoch>
+  /rollups/<device>?tier=rollup_1h&start=<epoch>&end=<epoch>
+
+<device> is either the device id or the serial number.  Responses are
+cached for a few seconds so busy dashboards don't cost much.
+"""
+import http.server
+import json
+import threading
+import time
+import udi_interface
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
+from nodes import history
+
+LOGGER = udi_interface.LOGGER
+
+WORKERS = 4
+MAX_MINUTES = 72 * 60
+MAILBOX_TIMEOUT = 10    # seconds to wait for a device or station mailbox
+
+# How long each kind of response is cached, in seconds
+CACHE_TTL = {
+        'devices': 60,
+        'eto': 60,
+        'current': 5,
+        'stats': 30,
+        'wind': 5,
+        'summary': 60,
+        'rollups': 60,
+        }
+
+
+class PoolServer(http.server.HTTPServer):
+    """ HTTPServer that handles requests on a fixed size thread pool """
+
+    def __init__(self, address, handler, workers=WORKERS):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        api = self.server.api
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+
+        if len(parts) == 0 or parts[0] not in CACHE_TTL:
+            self._send(404, {'error': 'Unknown request {}'.format(url.path)})
+            return
+
+        key = url.path + '?' + url.query
+        body = api.cache_get(key)
+        if body is None:
+            try:
+                status, result = api.handle(parts, parse_qs(url.query))
+            except ValueError as e:
+                status, result = 400, {'error': str(e)}
+            except Exception as e:
+                LOGGER.error('HTTP request {} failed: {}'.format(self.path, e))
+                status, result = 500, {'error': 'Internal error'}
+
+            body = json.dumps(result).encode('utf-8')
+            if status != 200:
+                self._send(status, body)
+                return
+            api.cache_put(key, body, CACHE_TTL[parts[0]])
+
+        self._send(200, body)
+
+    def _send(self, status, body):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('HTTP {} {}'.format(self.address_string(), format % args))
+
+
+def _round(value):
+    # history keeps most values as 32 bit floats, don't show the noise
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, dict):
+        return {k: _round(v) for k, v in value.items()}
+    return value
+
+
+def _wind(wind):
+    """ Snapshot of a node's WindStats, run in the device's mailbox """
+    gust, gust_dir = wind.gust.peak()
+    return {'avg_2min': wind.avg2.speed(), 'dir_2min': wind.avg2.direction(),
+            'avg_10min': wind.avg10.speed(), 'dir_10min': wind.avg10.direction(),
+            'gust_10min': gust, 'gust_dir_10min': gust_dir}
+
+
+class HttpApi(object):
+    def __init__(self, controller, port):
+        self.controller = controller
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.server = PoolServer(('', self.port), Handler)
+        self.server.api = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        LOGGER.info('HTTP API listening on port {}'.format(self.port))
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def cache_get(self, key):
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def cache_put(self, key, body, ttl):
+        now = time.time()
+        with self.lock:
+            if len(self.cache) > 1000:
+                # drop anything that has expired
+                self.cache = {k: v for k, v in self.cache.items() if v[0] > now}
+            self.cache[key] = (now + ttl, body)
+
+    def _device(self, ident):
+        for d, info in self.controller.deviceList.items():
+            if str(d) == ident or info['serial_number'] == ident:
+                return d
+        return None
+
+    def _int(self, query, name, default):
+        try:
+            return int(query[name][0]) if name in query else default
+        except ValueError:
+            raise ValueError('{} must be a number'.format(name))
+
+    def handle(self, parts, query):
+        """ Return (status, result) for a request """
+        if parts[0] == 'devices':
+            return 200, [{'device_id': d, 'serial_number': info['serial_number'],
+                          'type': info['type'], 'remote': info['remote']}
+                         for d, info in list(self.controller.deviceList.items())]
+
+        if parts[0] == 'eto':
+            # The tracker is only changed in its station's mailbox, so
+            # read it there too.
+            futures = {station: self.controller.actors.call(('eto', station), tracker.today)
+                       for station, tracker in list(self.controller.eto.items())}
+            return 200, {station: round(f.result(MAILBOX_TIMEOUT), 3) for station, f in futures.items()}
+
+        if len(parts) < 2:
+            raise ValueError('Missing device')
+        device_id = self._device(parts[1])
+        if device_id is None:
+            return 404, {'error': 'Unknown device {}'.format(parts[1])}
+
+        now = int(time.time())
+        if parts[0] == 'current':
+            h = self.controller.history.get(device_id)
+            obs = h.newest() if h is not None else None
+            if obs is None:
+                return 404, {'error': 'No observations for {}'.format(parts[1])}
+            return 200, _round(obs.as_dict())
+
+        if parts[0] == 'stats':
+            h = self.controller.history.get(device_id)
+            if h is None:
+                return 404, {'error': 'No observations for {}'.format(parts[1])}
+            minutes = min(max(self._int(query, 'minutes', 60), 1), MAX_MINUTES)
+            start = now - minutes * 60
+            result = {'start': start, 'end': now}
+            for f in history.FIELDS:
+                result[f] = {'min': h.min(f, start, now), 'max': h.max(f, start, now),
+                             'mean': h.mean(f, start, now), 'sum': h.sum(f, start, now)}
+            return 200, _round(result)
+
+        if parts[0] == 'wind':
+            node = self.controller.poly.getNode(device_id)
+            if node is None or not hasattr(node, 'wind'):
+                return 404, {'error': 'No wind data for {}'.format(parts[1])}
+            # The wind statistics are changed in the device's mailbox
+            return 200, self.controller.actors.call(device_id, _wind, node.wind).result(MAILBOX_TIMEOUT)
+
+        archive = self.controller.archive
+        if archive is None:
+            return 404, {'error': 'The archive is not available'}
+        start = self._int(query, 'start', now - 86400)
+        end = self._int(query, 'end', now)
+
+        if parts[0] == 'summary':
+            field = query['field'][0] if 'field' in query else 'rain'
+            result = archive.query(device_id, field, start, end)
+            result.update({'field': field, 'start': start, 'end': end})
+            return 200, result
+
+        tier = query['tier'][0] if 'tier' in query else 'rollup_1h'
+        return 200, archive.rollups(device_id, tier, start, end)
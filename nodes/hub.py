@@ -1,156 +1,181 @@
 #!/usr/bin/env python3
 """
-Polyglot v2 node server for WeatherFlow Weather Station data.
-Copyright (c) 2018,2019 Robert Paauwe
-"""
-import polyinterface
-import sys
-import time
-import datetime
-import urllib3
-import json
-import socket
-import math
-import threading
-
-LOGGER = polyinterface.LOGGER
-
-# How do we do some initialization when the class object is created?
-# can we manuipulate the node somewhat here?
-
-class HubNode(polyinterface.Node):
-    # we want drivers to be dynamically created, is that possible?
-    # can we override the default init?
-    drivers = []
-    hint = [1,11,0,0]
-    address = ''
-    name = ''
-    primary = ''
-
-    def __init__(self, controller, primary, address, name, devices):
-        self.tempest = False
-        self.sky = False
-        self.air = False
-        for device in devices:
-            if 'SK' in device:
-                self.sky = True
-                LOGGER.debug('add sky battery and RSSI')
-                HubNode.drivers.append({'driver': 'GV1',  'value': 0, 'uom': 72, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV3',  'value': 0, 'uom': 56, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV13', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV14', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV15', 'value': 0, 'uom': 25, 'name': ''})
-            if 'AR' in device:
-                self.air = True
-                LOGGER.debug('add air battery and RSSI')
-                HubNode.drivers.append({'driver': 'GV0',  'value': 0, 'uom': 72, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV2',  'value': 0, 'uom': 56, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV7',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV8',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV9',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV10', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV11', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV12', 'value': 0, 'uom': 25, 'name': ''})
-            if 'ST' in device:
-                self.tempest = True
-                LOGGER.debug('add tempest battery and RSSI')
-                HubNode.drivers.append({'driver': 'GV5',  'value': 0, 'uom': 72, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV6',  'value': 0, 'uom': 56, 'name': ''})
-
-                HubNode.drivers.append({'driver': 'GV7',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV8',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV9',  'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV10', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV11', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV12', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV13', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV14', 'value': 0, 'uom': 25, 'name': ''})
-                HubNode.drivers.append({'driver': 'GV15', 'value': 0, 'uom': 25, 'name': ''})
-        LOGGER.debug(HubNode.drivers)
-        if self.tempest:
-            HubNode.id = 'hub2'
-        elif self.air and self.sky:
-            HubNode.id = 'hub3'
-        elif self.air:
-            HubNode.id = 'hub1'
-        elif self.sky:
-            HubNode.id = 'hub0'
-        else:
-            LOGGER.error('No sensor devices found (Sky, Air, Tempest)')
-
-        # call the default init
-        super(HubNode, self).__init__(controller, primary, address, name)
-
-
-    def SetUnits(self, u):
-        self.units = u
-
-    def setDriver(self, driver, value):
-        super(HubNode, self).setDriver(driver, value, report=True, force=True)
-
-    def update_rssi(self, rssi_1=None, rssi_2=None):
-        if self.tempest:
-            self.setDriver('GV6', rssi_1)
-        else:
-            if rssi_2 is not None:
-                self.setDriver('GV3', rssi_2)
-            if rssi_1 is not None:
-                self.setDriver('GV2', rssi_1)
-
-    # updates the voltage(s)
-    def update(self, v1=None, v2=None):
-        if self.tempest:
-            self.setDriver('GV5', v1)
-        else:
-            if v1 is not None:
-                self.setDriver('GV0', v1)
-            if v2 is not None:
-                self.setDriver('GV1', v2)
-
-
-    def update_sensors(self, status):
-        if (status & 0x0001) == 0x0001:
-            self.setDriver('GV7', 1)
-        else:
-            self.setDriver('GV7', 0)
-
-        if (status & 0x0002) == 0x0002:
-            self.setDriver('GV8', 1)
-        else:
-            self.setDriver('GV8', 0)
-
-        if (status & 0x0004) == 0x0004:
-            self.setDriver('GV9', 1)
-        else:
-            self.setDriver('GV9', 0)
-
-        if (status & 0x0008) == 0x0008:
-            self.setDriver('GV10', 1)
-        else:
-            self.setDriver('GV10', 0)
-
-        if (status & 0x0010) == 0x0010:
-            self.setDriver('GV11', 1)
-        else:
-            self.setDriver('GV11', 0)
-
-        if (status & 0x0020) == 0x0020:
-            self.setDriver('GV12', 1)
-        else:
-            self.setDriver('GV12', 0)
-
-        if (status & 0x0040) == 0x0040:
-            self.setDriver('GV13', 1)
-        else:
-            self.setDriver('GV13', 0)
-
-        if (status & 0x0080) == 0x0080:
-            self.setDriver('GV14', 1)
-        else:
-            self.setDriver('GV14', 0)
-
-        if (status & 0x0100) == 0x0100:
-            self.setDriver('GV15', 1)
-        else:
-            self.setDriver('GV15', 0)
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Hub and device status.
 
+Hubs send hub_status and devices send device_status every few seconds.
+StatusTracker keeps the newest values for each one in a set of arrays,
+one slot per serial number, and decides when they're worth sending to
+the ISY: right away for a new hub or device or a change in the sensor
+status, otherwise no more than once a minute.  The nodes are created
+the first time a hub or device reports.
+"""
+import array
+import udi_interface
+
+LOGGER = udi_interface.LOGGER
+
+MIN_PUBLISH = 60    # seconds between updates for RSSI and voltage changes
+
+# sensor_status bits, in the order of the status node's sensor drivers
+SENSORS = (
+        'lightning failed',
+        'lightning noise',
+        'lightning disturber',
+        'pressure failed',
+        'temperature failed',
+        'humidity failed',
+        'wind failed',
+        'precipitation failed',
+        'light/uv failed',
+        )
+SENSOR_DRIVERS = ('GV3', 'GV4', 'GV5', 'GV6', 'GV7', 'GV8', 'GV9', 'GV10', 'GV11')
+SENSOR_MASK = (1 << len(SENSORS)) - 1
+
+# sensor_status -> value of each sensor driver
+SENSOR_TABLE = tuple(tuple((status >> bit) & 1 for bit in range(len(SENSORS)))
+                     for status in range(SENSOR_MASK + 1))
+
+
+def sensors(status):
+    return SENSOR_TABLE[status & SENSOR_MASK]
+
+
+class StatusTracker(object):
+    """
+      Newest status for each hub and device.  Values are kept as
+      seen (epoch), rssi, hub_rssi, voltage, sensor_status, uptime and
+      firmware.
+    """
+    FIELDS = (('seen', 'd'), ('published', 'd'), ('rssi', 'h'), ('hub_rssi', 'h'),
+              ('voltage', 'f'), ('status', 'l'), ('uptime', 'q'), ('firmware', 'l'),
+              ('dirty', 'b'))
+
+    def __init__(self):
+        self.slots = {}     # serial number -> slot
+        self.serials = []
+        for name, typecode in self.FIELDS:
+            setattr(self, name, array.array(typecode))
+
+    def __contains__(self, serial):
+        return serial in self.slots
+
+    def _slot(self, serial):
+        slot = self.slots.get(serial)
+        if slot is None:
+            # Readers look up the slot, so add it last
+            slot = len(self.serials)
+            for name, typecode in self.FIELDS:
+                getattr(self, name).append(0)
+            self.serials.append(serial)
+            self.slots[serial] = slot
+        return slot
+
+    def update(self, serial, now, rssi=0, hub_rssi=0, voltage=0.0, status=0, uptime=0, firmware=0):
+        """
+          Record a status message.  Returns True if it should be
+          published now.
+        """
+        new = serial not in self.slots
+        slot = self._slot(serial)
+        self.seen[slot] = now
+        self.uptime[slot] = int(uptime)
+
+        urgent = new or self.status[slot] != status or self.firmware[slot] != firmware
+        changed = urgent or self.rssi[slot] != rssi or self.hub_rssi[slot] != hub_rssi or \
+                abs(self.voltage[slot] - voltage) >= 0.005
+
+        self.rssi[slot] = rssi
+        self.hub_rssi[slot] = hub_rssi
+        self.voltage[slot] = voltage
+        self.status[slot] = status
+        self.firmware[slot] = firmware
+
+        # A change held back by the limit is still sent once it's allowed,
+        # even if nothing changes after it.
+        if changed:
+            self.dirty[slot] = 1
+        if urgent or (self.dirty[slot] and now - self.published[slot] >= MIN_PUBLISH):
+            self.published[slot] = now
+            self.dirty[slot] = 0
+            return True
+        return False
+
+    def age(self, serial, now):
+        """ Seconds since the hub or device last reported """
+        return int(now - self.seen[self.slots[serial]])
+
+    def newest(self):
+        """ Time of the newest status from anything, 0 if none """
+        return max(self.seen) if len(self.seen) > 0 else 0
+
+    def values(self, serial):
+        slot = self.slots[serial]
+        return {name: getattr(self, name)[slot] for name, typecode in self.FIELDS}
+
+
+def address(serial):
+    # HB-00012345 -> hb00012345, ST-00012345 -> st00012345_s
+    a = serial.replace('-', '').lower()
+    return a if a.startswith('hb') else a + '_s'
+
+
+class HubNode(udi_interface.Node):
+    id = 'hub'
+    drivers = [
+            {'driver': 'ST',  'value': 0, 'uom': 57, 'name': 'Seconds Since Seen'},
+            {'driver': 'GV0', 'value': 0, 'uom': 56, 'name': 'RSSI'},
+            {'driver': 'GV1', 'value': 0, 'uom': 57, 'name': 'Uptime'},
+            {'driver': 'GV2', 'value': 0, 'uom': 56, 'name': 'Firmware'},
+            ]
+
+    def __init__(self, polyglot, primary, address, name):
+        super(HubNode, self).__init__(polyglot, primary, address, name)
+
+    def publish(self, values, age):
+        self.setDriver('ST', age)
+        self.setDriver('GV0', values['rssi'])
+        self.setDriver('GV1', values['uptime'])
+        self.setDriver('GV2', values['firmware'])
+
+
+class StatusNode(udi_interface.Node):
+    id = 'devstatus'
+    drivers = [
+            {'driver': 'ST',      'value': 0, 'uom': 57, 'name': 'Seconds Since Seen'},
+            {'driver': 'BATLVL',  'value': 0, 'uom': 72, 'name': 'Battery'},
+            {'driver': 'GV0',     'value': 0, 'uom': 56, 'name': 'RSSI'},
+            {'driver': 'GV1',     'value': 0, 'uom': 56, 'name': 'Hub RSSI'},
+            {'driver': 'GV2',     'value': 0, 'uom': 57, 'name': 'Uptime'},
+            ] + [{'driver': d, 'value': 0, 'uom': 2, 'name': s.capitalize()}
+                 for d, s in zip(SENSOR_DRIVERS, SENSORS)]
+
+    def __init__(self, polyglot, primary, address, name):
+        super(StatusNode, self).__init__(polyglot, primary, address, name)
+
+    def publish(self, values, age):
+        self.setDriver('ST', age)
+        self.setDriver('BATLVL', round(values['voltage'], 2))
+        self.setDriver('GV0', values['rssi'])
+        self.setDriver('GV1', values['hub_rssi'])
+        self.setDriver('GV2', values['uptime'])
+        for driver, value in zip(SENSOR_DRIVERS, sensors(values['status'])):
+            self.setDriver(driver, value)
+
+
+if __name__ == '__main__':
+    import time
+
+    tracker = StatusTracker()
+    published = 0
+    start = time.time()
+    # 20 devices reporting every 3 seconds for a day, RSSI wobbling
+    for i in range(20 * 28800):
+        now = 1000000 + i * 3 / 20
+        if tracker.update('ST-{:08d}'.format(i % 20), now, rssi=-60 - (i // 20) % 3,
+                          voltage=2.6, status=0x8000 if i > 300000 else 0):
+            published += 1
+    print('{} updates, {} published, {:.2f}s'.format(20 * 28800, published, time.time() - start))
+    print(sensors(0x1ff), sensors(0x8004))
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Lightning strike events.
+
+The observations only have a strike count and average distance for the
+reporting interval, so they can be a minute behind a storm.  Air and
+Tempest devices also send an evt_strike message for every strike.  Those
+are kept here in 10, 30 and 60 minute windows with the strike count,
+nearest strike and the time of the last strike for each device.
+
+Adding a strike and expiring old ones is O(1) amortized.  Counts are a
+deque of timestamps.  Nearest distance uses a deque that only holds
+strikes that can still become the nearest, in increasing order of
+distance, so the nearest is always at the front (like the peak gust in
+wind.py).
+"""
+import threading
+from collections import deque
+
+WINDOWS = (600, 1800, 3600)     # seconds
+MIN_PUBLISH = 15                # seconds between updates for more strikes
+
+
+class StrikeWindow(object):
+    """ Strike count and nearest strike over the last 'seconds' seconds """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.times = deque()
+        self.nearest_q = deque()    # (ts, distance), increasing distance
+
+    def add(self, ts, distance):
+        self.times.append(ts)
+        while self.nearest_q and self.nearest_q[-1][1] >= distance:
+            self.nearest_q.pop()
+        self.nearest_q.append((ts, distance))
+        self.expire(ts)
+
+    def expire(self, now):
+        while self.times and self.times[0] <= now - self.seconds:
+            self.times.popleft()
+        while self.nearest_q and self.nearest_q[0][0] <= now - self.seconds:
+            self.nearest_q.popleft()
+
+    def count(self):
+        return len(self.times)
+
+    def nearest(self):
+        """ Distance in km of the nearest strike, None if there weren't any """
+        return self.nearest_q[0][1] if self.nearest_q else None
+
+
+class StrikeStats(object):
+    """ Strike windows for one device """
+    def __init__(self):
+        self.windows = [StrikeWindow(s) for s in WINDOWS]
+        self.last = 0           # time of the last strike
+        self.published = 0
+        self.pending = False
+
+    def add(self, ts, distance, now):
+        """
+          Record a strike.  Returns how many seconds until it should be
+          published, 0 for right away, or None if a publish is already
+          waiting.  The first strike in 10 minutes and one closer than
+          any in the last 10 minutes are published right away, otherwise
+          no more than every MIN_PUBLISH seconds.
+        """
+        # Strikes can arrive a little out of order, keep the deques sorted
+        ts = max(ts, self.last)
+        recent = self.windows[0]
+        recent.expire(ts)
+        urgent = recent.count() == 0 or distance < recent.nearest()
+        for w in self.windows:
+            w.add(ts, distance)
+        self.last = ts
+
+        wait = MIN_PUBLISH - (now - self.published)
+        if urgent or wait <= 0:
+            return 0
+        if self.pending:
+            return None
+        self.pending = True
+        return wait
+
+    def values(self, now):
+        """
+          Returns ([(count, nearest km)] for each window, minutes since
+          the last strike or None if there hasn't been one).
+        """
+        for w in self.windows:
+            w.expire(now)
+        minutes = max(int((now - self.last) // 60), 0) if self.last else None
+        return [(w.count(), w.nearest()) for w in self.windows], minutes
+
+
+class StrikeTracker(object):
+    """ Strike windows for every device, by device id """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def add(self, device_id, ts, distance, now):
+        with self.lock:
+            stats = self.devices.get(device_id)
+            if stats is None:
+                stats = StrikeStats()
+                self.devices[device_id] = stats
+            return stats.add(ts, distance, now)
+
+    def take(self, device_id, now):
+        """ Current values for the device and mark them published """
+        with self.lock:
+            stats = self.devices[device_id]
+            stats.published = now
+            stats.pending = False
+            return stats.values(now)
+
+    def device_ids(self):
+        with self.lock:
+            return list(self.devices)
+
+
+def publish(node, values, minutes, units):
+    """
+      Set the node's strike window drivers.  node.strike_drivers lists
+      the count and nearest drivers for each window followed by the
+      minutes since the last strike driver.
+    """
+    if units.get('distance') == 'mi':
+        factor = 1 / 1.609344
+        uom = 116
+    else:
+        factor = 1
+        uom = 83
+
+    drivers = node.strike_drivers
+    for i, (count, nearest) in enumerate(values):
+        node.setDriver(drivers[i * 2], count, True, False, 56)
+        node.setDriver(drivers[i * 2 + 1], round(nearest * factor, 1) if nearest is not None else 0, True, False, uom)
+    node.setDriver(drivers[-1], minutes if minutes is not None else -1, True, False, 45)
+
+
+if __name__ == '__main__':
+    # A long storm with strikes every few seconds, checked against
+    # counting the windows directly.  Deferred publishes happen at the
+    # next strike after they're due.
+    import random
+    import time
+
+    tracker = StrikeTracker()
+    strikes = []
+    published = 0
+    due = None
+    ts = 1600000000
+    begin = time.time()
+    for i in range(200000):
+        ts += random.choice((0, 0, 1, 2, 5))
+        distance = random.randint(1, 40)
+        strikes.append((ts, distance))
+        wait = tracker.add(1234, ts, distance, ts)
+        if wait is not None and wait > 0:
+            due = ts + wait
+        if wait == 0 or (due is not None and ts >= due):
+            tracker.take(1234, ts)
+            published += 1
+            due = None
+    elapsed = time.time() - begin
+
+    values, minutes = tracker.take(1234, ts)
+    for (count, nearest), seconds in zip(values, WINDOWS):
+        recent = [d for (t, d) in strikes if t > ts - seconds]
+        assert count == len(recent) and nearest == min(recent), (seconds, count, nearest)
+    print('{} strikes in {:.2f}s ({:.0f}/s), {} published, windows {}, {} minutes since the last'.format(
+        len(strikes), elapsed, len(strikes) / elapsed, published, values, minutes))
@@ -27,8 +27,6 @@ class NCRainNode(udi_interface.Node):
     def __init__(self, polyglot, primary, address, name):
         super(NCRainNode, self).__init__(polyglot, primary, address, name)
 
-        self.prev = datetime.datetime.now()
-        self.device_type = ''
         self.rd = {
                 'nc_hourly': 0,
                 'nc_daily': 0,
@@ -37,62 +35,29 @@ class NCRainNode(udi_interface.Node):
                 'nc_yearly': 0,
                 'nc_yesterday': 0
                 }
-        
-    def rain_update(self, current_rain):
-        # Update the accumulators and drivers
-        now = datetime.datetime.now()
-        (y, w, d) = now.isocalendar()
 
-        if now.hour != self.prev.hour:
-            self.rd['nc_hourly'] = 0 
-        self.rd['nc_hourly'] += current_rain
-
-        if now.day != self.prev.day:
-            self.rd['nc_yesterday'] = self.rd['daily']
-            self.rd['nc_daily'] = 0
-        self.rd['nc_daily'] += current_rain
-
-        if w != self.prev.isocalendar()[1]:
-            self.rd['nc_weekly'] = 0
-        self.rd['nc_weekly'] += current_rain
-
-        if now.month != self.prev.month:
-            self.rd['nc_monthly'] = 0
-        self.rd['nc_monthly'] += current_rain
-
-        if now.year != self.prev.year:
-            self.rd['nc_yearly'] = 0
-        self.rd['nc_yearly'] += current_rain
+    def InitRain(self, rain):
+        # The accumulator is owned by the device node and updates us
+        # at the same time it updates that node.
+        self.rd = rain.nc_rd
+        rain.nc_node = self
 
+    def rain_publish(self, force=False):
         # convert rain values if neccessary
         if self.units['rain'] == 'in':
             uom = 105  # inches
-            self.setDriver('PRECIP', round(self.rd['nc_daily'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV2', round(self.rd['nc_hourly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV3', round(self.rd['nc_weekly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV4', round(self.rd['nc_monthly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV5', round(self.rd['nc_yearly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV6', round(self.rd['nc_yesterday'] * 0.03937, 2), uom=uom)
+            self.setDriver('PRECIP', round(self.rd['nc_daily'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV2', round(self.rd['nc_hourly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV3', round(self.rd['nc_weekly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV4', round(self.rd['nc_monthly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV5', round(self.rd['nc_yearly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV6', round(self.rd['nc_yesterday'] * 0.03937, 2), uom=uom, force=force)
         else:
             uom = 82 # mm
-            self.setDriver('PRECIP', round(self.rd['nc_daily'], 3), uom=uom)
-            self.setDriver('GV2', round(self.rd['nc_hourly'], 3), uom=uom)
-            self.setDriver('GV3', round(self.rd['nc_weekly'], 3), uom=uom)
-            self.setDriver('GV4', round(self.rd['nc_monthly'], 3), uom=uom)
-            self.setDriver('GV5', round(self.rd['nc_yearly'], 3), uom=uom)
-            self.setDriver('GV6', round(self.rd['nc_yesterday'], 3), uom=uom)
-
-        self.prev = now
-
-    def update(self, obs, force):
-        try:
-            tm = obs[0][0]  # epoch
-
-            # NC Rain value from obs
-            ra = float(obs[0][14]) if self.device_type == 'SK' else float(obs[0][19])
-
-            self.rain_update(ra)
-
-        except Exception as e:
-            LOGGER.error('Failure in NCRain data: ' + str(e))
+            self.setDriver('PRECIP', round(self.rd['nc_daily'], 3), uom=uom, force=force)
+            self.setDriver('GV2', round(self.rd['nc_hourly'], 3), uom=uom, force=force)
+            self.setDriver('GV3', round(self.rd['nc_weekly'], 3), uom=uom, force=force)
+            self.setDriver('GV4', round(self.rd['nc_monthly'], 3), uom=uom, force=force)
+            self.setDriver('GV5', round(self.rd['nc_yearly'], 3), uom=uom, force=force)
+            self.setDriver('GV6', round(self.rd['nc_yesterday'], 3), uom=uom, force=force)
 
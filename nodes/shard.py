@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Multi-process ingest.
+
+With a lot of devices, decoding observations, calculating the derived
+values, accumulating rain and working out which drivers changed is more
+than one Python thread keeps up with.  When enabled, devices are split
+across worker processes by serial number.  Each worker keeps a shadow
+copy of its device nodes, which are the regular node classes with
+setDriver replaced so it only records the drivers that changed.  Those
+changes and the decoded observations go back to the node server, which
+just passes them on to the real nodes and the history.
+
+Messages to a worker are sent in batches, every FLUSH seconds or once
+BATCH have been collected, since sending each one through a queue costs
+about as much as processing it.
+
+Only the wind statistics of the node server's own nodes are kept up to
+date (for the HTTP API), everything else about them is in the workers.
+"""
+import multiprocessing
+import queue
+import threading
+import zlib
+import udi_interface
+from nodes import accumulator
+from nodes import air
+from nodes import history
+from nodes import ncrain
+from nodes import sky
+from nodes import tempest
+
+LOGGER = udi_interface.LOGGER
+
+BATCH = 64      # most messages sent to a worker at once
+FLUSH = 0.05    # seconds a message can wait for the rest of its batch
+
+
+class ShadowBase(object):
+    """
+      Mixin that turns a node into a shadow node.  setDriver only
+      records changes in the shard's list of deltas as
+      (address, driver, value, uom, force).
+    """
+    def __init__(self, address, shard, units):
+        super(ShadowBase, self).__init__(None, address, address, address)
+        self.shard = shard
+        self.units = units
+        self.last = {}
+
+    def setDriver(self, driver, value, report=True, force=False, uom=None, text=None):
+        if not force and self.last.get(driver) == (value, uom):
+            return
+        self.last[driver] = (value, uom)
+        self.shard.deltas.append((self.address, driver, value, uom, force))
+
+    def reportDrivers(self):
+        pass
+
+    def reportCmd(self, command, value=None, uom=None):
+        pass
+
+
+class ShadowTempest(ShadowBase, tempest.TempestNode):
+    pass
+
+class ShadowAir(ShadowBase, air.AirNode):
+    pass
+
+class ShadowSky(ShadowBase, sky.SkyNode):
+    pass
+
+class ShadowNCRain(ShadowBase, ncrain.NCRainNode):
+    pass
+
+SHADOWS = {'ST': ShadowTempest, 'AR': ShadowAir, 'SK': ShadowSky}
+
+
+def pack(o):
+    """ Observation to a plain tuple, smaller to send between processes """
+    return (o.timestamp,) + tuple(getattr(o, f) for f in history.FIELDS)
+
+def unpack(t):
+    o = history.Observation(t[0])
+    for f, v in zip(history.FIELDS, t[1:]):
+        setattr(o, f, v)
+    return o
+
+
+class Shard(object):
+    """ The devices handled by one worker process """
+    def __init__(self):
+        self.devices = {}       # serial number -> (device id, type, node, first)
+        self.deltas = []
+        self.observations = []  # (device id, [packed observation])
+
+    def add(self, serial, config):
+        """
+          config has the device's device_id, type, units, elevation,
+          timezone, rain totals (rd, nc_rd) and nc (True when there's a
+          nearcast rain node).
+        """
+        shadow = SHADOWS.get(config['type'])
+        if shadow is None:
+            return
+        device_id = config['device_id']
+        node = shadow(device_id, self, config['units'])
+        if hasattr(node, 'SetElevation'):
+            node.SetElevation(config['elevation'])
+        if hasattr(node, 'InitRain'):
+            rain = accumulator.RainAccumulator(config['rd'], config['nc_rd'], config['timezone'])
+            node.InitRain(rain)
+            if config['nc']:
+                nc = ShadowNCRain(str(device_id) + '_nc', self, config['units'])
+                nc.InitRain(rain)
+        self.devices[serial] = [device_id, config['type'], node, True]
+
+    def observation(self, serial, obs, force):
+        device = self.devices.get(serial)
+        if device is None:
+            return
+        device_id, device_type, node, first = device
+        node.update(obs, force or first)
+        device[3] = False
+
+        decoded = []
+        for ob in obs:
+            try:
+                o = history.decode(device_type, ob)
+            except Exception as e:
+                LOGGER.debug('Failed to decode observation: {}'.format(e))
+                continue
+            if o is not None:
+                decoded.append(pack(o))
+        if decoded:
+            self.observations.append((device_id, decoded))
+
+    def rapid_wind(self, serial, ob, publish):
+        device = self.devices.get(serial)
+        if device is not None and hasattr(device[2], 'rapid_wind'):
+            device[2].rapid_wind(ob, publish=publish)
+
+    def handle(self, msg):
+        if msg[0] == 'obs':
+            self.observation(msg[1], msg[2], msg[3])
+        elif msg[0] == 'wind':
+            self.rapid_wind(msg[1], msg[2], msg[3])
+        elif msg[0] == 'add':
+            self.add(msg[1], msg[2])
+
+    def take(self):
+        """ Return and clear the (deltas, observations) so far """
+        result = (self.deltas, self.observations)
+        self.deltas = []
+        self.observations = []
+        return result
+
+
+def worker(inbox, results):
+    shard = Shard()
+    while True:
+        msgs = inbox.get()
+        if msgs is None:
+            return
+        # Take whatever else is waiting so the results go back together
+        while len(msgs) < BATCH:
+            try:
+                more = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if more is None:
+                inbox.put(None)
+                break
+            msgs.extend(more)
+
+        for msg in msgs:
+            try:
+                shard.handle(msg)
+            except Exception as e:
+                LOGGER.error('Failed to process {} for {}: {}'.format(msg[0], msg[1], e))
+
+        deltas, observations = shard.take()
+        if deltas or observations:
+            results.put((deltas, observations))
+
+
+class ShardPool(object):
+    """
+      Worker processes plus a thread that hands their results to
+      apply(deltas, observations).
+    """
+    def __init__(self, workers, apply):
+        ctx = multiprocessing.get_context('spawn')
+        self.apply = apply
+        self.results = ctx.Queue()
+        self.inboxes = []
+        self.processes = []
+        for i in range(workers):
+            inbox = ctx.Queue()
+            p = ctx.Process(target=worker, args=(inbox, self.results), name='shard-{}'.format(i))
+            p.daemon = True
+            p.start()
+            self.inboxes.append(inbox)
+            self.processes.append(p)
+
+        # Messages waiting to be sent to each worker
+        self.lock = threading.Lock()
+        self.pending = [[] for i in range(workers)]
+        self.stopping = threading.Event()
+
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+        self.flusher = threading.Thread(target=self._flush_loop)
+        self.flusher.daemon = True
+        self.flusher.start()
+        LOGGER.info('Started {} shard workers'.format(workers))
+
+    def _send(self, serial, msg):
+        # crc32, not hash(), so a device always lands on the same worker
+        i = zlib.crc32(serial.encode('utf-8')) % len(self.inboxes)
+        with self.lock:
+            self.pending[i].append(msg)
+            if len(self.pending[i]) >= BATCH:
+                self._flush(i)
+
+    def _flush(self, i):
+        """ Send worker i what's waiting for it, lock held """
+        if self.pending[i]:
+            self.inboxes[i].put(self.pending[i])
+            self.pending[i] = []
+
+    def _flush_loop(self):
+        while not self.stopping.wait(FLUSH):
+            with self.lock:
+                for i in range(len(self.inboxes)):
+                    self._flush(i)
+
+    def add_device(self, serial, config):
+        self._send(serial, ('add', serial, config))
+
+    def observation(self, serial, obs, force=False):
+        self._send(serial, ('obs', serial, obs, force))
+
+    def rapid_wind(self, serial, ob, publish=True):
+        self._send(serial, ('wind', serial, ob, publish))
+
+    def _read(self):
+        while True:
+            msg = self.results.get()
+            if msg is None:
+                return
+            try:
+                self.apply(msg[0], msg[1])
+            except Exception as e:
+                LOGGER.error('Failed to apply shard results: {}'.format(e))
+
+    def stop(self):
+        self.stopping.set()
+        with self.lock:
+            for i, inbox in enumerate(self.inboxes):
+                self._flush(i)
+                inbox.put(None)
+        for p in self.processes:
+            p.join(2)
+            if p.is_alive():
+                p.terminate()
+        self.results.put(None)
+
+
+if __name__ == '__main__':
+    # 50 Tempests sending observations and rapid wind.  Run as
+    # python -m nodes.shard from the node server directory.
+    #
+    # Two numbers for each run: wall time, and CPU time used by this
+    # process.  In the node server this process also runs the UDP
+    # receive loop and publishes to the ISY, so the CPU it spends per
+    # message is what limits how many devices it keeps up with.  That
+    # goes down with workers on any machine.  Wall time only goes down
+    # when there are spare CPUs for the workers.
+    import os
+    import random
+    import time
+
+    DEVICES = 50
+    ROUNDS = 40
+    units = {'temperature': 'f', 'wind': 'mph', 'pressure': 'inhg',
+             'rain': 'in', 'distance': 'mi', 'other': 'imperial'}
+
+    def config(d):
+        return {'device_id': d, 'type': 'ST', 'units': units, 'elevation': 100,
+                'timezone': None, 'rd': {}, 'nc_rd': {}, 'nc': False}
+
+    messages = []
+    start = int(time.time()) - ROUNDS * 60
+    for r in range(ROUNDS):
+        ts = start + r * 60
+        for d in range(DEVICES):
+            serial = 'ST-{:08d}'.format(d)
+            messages.append(('obs', serial, [[ts, 1.0, random.uniform(0, 8), 9.0, random.randint(0, 359),
+                                              3, 1013.0 + random.random(), random.uniform(-5, 35),
+                                              random.uniform(20, 90), 20000, 2.5, 300,
+                                              random.choice((0, 0, 0.1)), 0, 0, 0, 2.6, 1]], False))
+            for i in range(20):
+                messages.append(('wind', serial, [ts + i * 3, random.uniform(0, 8), random.randint(0, 359)], True))
+    observations = ROUNDS * DEVICES
+    print('{} CPUs'.format(os.cpu_count()))
+
+    shard = Shard()
+    for d in range(DEVICES):
+        shard.add('ST-{:08d}'.format(d), config(d))
+    begin = time.time()
+    cpu = time.process_time()
+    for msg in messages:
+        shard.handle(msg)
+    single = time.time() - begin
+    single_cpu = time.process_time() - cpu
+    print('{} messages in one thread: {:.2f}s ({:.0f}/s), {:.1f}us CPU per message, {} deltas'.format(
+        len(messages), single, len(messages) / single, single_cpu / len(messages) * 1e6, len(shard.take()[0])))
+
+    for workers in (1, 2, 4):
+        done = threading.Event()
+        counts = [0, 0]
+
+        def apply(deltas, obs):
+            counts[0] += len(deltas)
+            counts[1] += sum(len(o[1]) for o in obs)
+            if counts[1] >= observations:
+                done.set()
+
+        pool = ShardPool(workers, apply)
+        for d in range(DEVICES):
+            pool.add_device('ST-{:08d}'.format(d), config(d))
+        time.sleep(1)   # let the workers start
+
+        begin = time.time()
+        cpu = time.process_time()
+        for msg in messages:
+            if msg[0] == 'obs':
+                pool.observation(msg[1], msg[2], msg[3])
+            else:
+                pool.rapid_wind(msg[1], msg[2], msg[3])
+        done.wait(120)
+        elapsed = time.time() - begin
+        used = time.process_time() - cpu
+        print('{} workers: {:.2f}s ({:.0f}/s), {:.1f}us CPU per message here ({:.1f}x less), {} deltas'.format(
+            workers, elapsed, len(messages) / elapsed, used / len(messages) * 1e6, single_cpu / used, counts[0]))
+        pool.stop()
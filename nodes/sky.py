@@ -8,6 +8,8 @@ import json
 import math
 import datetime
 import sys
+from nodes import accumulator
+from nodes import wind
 
 LOGGER = udi_interface.LOGGER
 
@@ -29,15 +31,23 @@ class SkyNode(udi_interface.Node):
             {'driver': 'SOLRAD',  'value': 0, 'uom': 74, 'name': 'Solar Radiation'}, # solar radiation
             {'driver': 'LUMIN',   'value': 0, 'uom': 36, 'name': 'Light Level'}, # Lux
             {'driver': 'BATLVL',  'value': 0, 'uom': 72, 'name': 'Battery'}, # battery
+            {'driver': 'GV7',     'value': 0, 'uom': 32, 'name': '2 Minute Wind Speed'}, # 2 min avg speed
+            {'driver': 'GV8',     'value': 0, 'uom': 76, 'name': '2 Minute Wind Direction'}, # 2 min avg direction
+            {'driver': 'GV9',     'value': 0, 'uom': 32, 'name': '10 Minute Wind Speed'}, # 10 min avg speed
+            {'driver': 'GV10',    'value': 0, 'uom': 76, 'name': '10 Minute Wind Direction'}, # 10 min avg direction
+            {'driver': 'GV11',    'value': 0, 'uom': 32, 'name': '10 Minute Peak Gust'}, # 10 min peak gust
+            {'driver': 'GV12',    'value': 0, 'uom': 76, 'name': 'Peak Gust Direction'}, # peak gust direction
+            {'driver': 'GV13',    'value': 0, 'uom': 25, 'name': 'Data Source'},  # UDP, REST or WebSocket
             ]
 
     units = {}
+    source_driver = 'GV13'
 
     def __init__(self, polyglot, primary, address, name):
         super(SkyNode, self).__init__(polyglot, primary, address, name)
 
         self.windspeed = 0
-        self.prev = datetime.datetime.now()
+        self.wind = wind.WindStats()
         self.rd = {
                 'hourly': 0,
                 'daily': 0,
@@ -46,55 +56,40 @@ class SkyNode(udi_interface.Node):
                 'yearly': 0,
                 'yesterday': 0
                 }
+        self.rain = accumulator.RainAccumulator(self.rd)
+        self.rain.node = self
         
-    def rain_update(self, current_rain):
-        # Update the accumulators and drivers
-        now = datetime.datetime.now()
-        (y, w, d) = now.isocalendar()
-
-        if now.hour != self.prev.hour:
-            self.rd['hourly'] = 0 
-        self.rd['hourly'] += current_rain
-
-        if now.day != self.prev.day:
-            self.rd['yesterday'] = self.rd['daily']
-            self.rd['daily'] = 0
-        self.rd['daily'] += current_rain
-
-        if w != self.prev.isocalendar()[1]:
-            self.rd['weekly'] = 0
-        self.rd['weekly'] += current_rain
-
-        if now.month != self.prev.month:
-            self.rd['monthly'] = 0
-        self.rd['monthly'] += current_rain
-
-        if now.year != self.prev.year:
-            self.rd['yearly'] = 0
-        self.rd['yearly'] += current_rain
+    def InitRain(self, rain):
+        # rain accumulator shared with the nearcast rain node
+        self.rain = rain
+        self.rd = rain.rd
+        rain.node = self
 
+    def rain_publish(self, force=False):
         # convert rain values if neccessary
         if self.units['rain'] == 'in':
             uom = 105  # inches
-            self.setDriver('PRECIP', round(self.rd['daily'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV2', round(self.rd['hourly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV3', round(self.rd['weekly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV4', round(self.rd['monthly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV5', round(self.rd['yearly'] * 0.03937, 2), uom=uom)
-            self.setDriver('GV6', round(self.rd['yesterday'] * 0.03937, 2), uom=uom)
+            self.setDriver('PRECIP', round(self.rd['daily'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV2', round(self.rd['hourly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV3', round(self.rd['weekly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV4', round(self.rd['monthly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV5', round(self.rd['yearly'] * 0.03937, 2), uom=uom, force=force)
+            self.setDriver('GV6', round(self.rd['yesterday'] * 0.03937, 2), uom=uom, force=force)
         else:
             uom = 82 # mm
-            self.setDriver('PRECIP', round(self.rd['daily'], 3), uom=uom)
-            self.setDriver('GV2', round(self.rd['hourly'], 3), uom=uom)
-            self.setDriver('GV3', round(self.rd['weekly'], 3), uom=uom)
-            self.setDriver('GV4', round(self.rd['monthly'], 3), uom=uom)
-            self.setDriver('GV5', round(self.rd['yearly'], 3), uom=uom)
-            self.setDriver('GV6', round(self.rd['yesterday'], 3), uom=uom)
-
-        self.prev = now
-
-    def rapid_wind(self, obs):
+            self.setDriver('PRECIP', round(self.rd['daily'], 3), uom=uom, force=force)
+            self.setDriver('GV2', round(self.rd['hourly'], 3), uom=uom, force=force)
+            self.setDriver('GV3', round(self.rd['weekly'], 3), uom=uom, force=force)
+            self.setDriver('GV4', round(self.rd['monthly'], 3), uom=uom, force=force)
+            self.setDriver('GV5', round(self.rd['yearly'], 3), uom=uom, force=force)
+            self.setDriver('GV6', round(self.rd['yesterday'], 3), uom=uom, force=force)
+
+    def rapid_wind(self, obs, force=False, publish=True):
         tm = obs[0]
+        self.wind.rapid(tm, obs[1], obs[2])
+        if not publish:
+            return
+
         ws = obs[1] * (18 / 5)  # wind speed from m/s to kph
         wd = obs[2]
 
@@ -104,10 +99,35 @@ class SkyNode(udi_interface.Node):
         elif self.units['wind'] == 'kph':
             uom = 32
         else:  # m/s
-            ws = round(wg * 5 / 18, 2)
+            ws = round(ws * 5 / 18, 2)
+            uom = 40
+        self.setDriver('SPEED', ws, uom=uom, force=force)
+        self.setDriver('WINDDIR', wd, force=force)
+
+    def wind_stats_update(self, force=False):
+        # rolling averages and peak gust are kept in m/s
+        if self.units['wind'] == 'mph':
+            factor = 3.6 / 1.609344
+            uom = 48
+        elif self.units['wind'] == 'kph':
+            factor = 3.6
+            uom = 32
+        else:  # m/s
+            factor = 1
             uom = 40
-        self.setDriver('SPEED', ws, uom=uom)
-        self.setDriver('WINDDIR', wd)
+
+        (gust, gust_dir) = self.wind.gust.peak()
+        for (spd, drv) in ((self.wind.avg2.speed(), 'GV7'),
+                           (self.wind.avg10.speed(), 'GV9'),
+                           (gust, 'GV11')):
+            if spd is not None:
+                self.setDriver(drv, round(spd * factor, 2), uom=uom, force=force)
+
+        for (wd, drv) in ((self.wind.avg2.direction(), 'GV8'),
+                          (self.wind.avg10.direction(), 'GV10'),
+                          (gust_dir, 'GV12')):
+            if wd is not None:
+                self.setDriver(drv, wd, force=force)
 
     def update(self, obs, force):
         # process sky data
@@ -135,9 +155,12 @@ class SkyNode(udi_interface.Node):
 
             sky_tm = tm
             self.windspeed = ws
+            self.wind.observation(tm, obs[0][5], obs[0][6], wd)
 
             # ra == mm/minute (or interval)  (conversion necessary)
-            self.rain_update(ra)
+            nc = obs[0][14] if len(obs[0]) > 14 else None  # REST only
+            self.rain.add(tm, ra, nc)
+            self.rain.publish(force)
 
             if self.units['rain'] == 'in':
                 uom = 24  # in/hr
@@ -174,6 +197,8 @@ class SkyNode(udi_interface.Node):
             self.setDriver('WINDDIR', wd)
             self.setDriver('BATLVL', bv)
 
+            self.wind_stats_update(force)
+
         except Exception as e:
             (t, v, tb) = sys.exec_info()
             LOGGER.error('Failure in SKY data: ' + str(e))
@@ -8,7 +8,9 @@ import json
 import math
 import datetime
 import sys
+from nodes import accumulator
 from nodes import derived
+from nodes import wind
 
 LOGGER = udi_interface.LOGGER
 
@@ -42,16 +44,35 @@ class TempestNode(udi_interface.Node):
             {'driver': 'SOLRAD',  'value': 0, 'uom': 74, 'name': 'Solar Radiation'},  # solar radiation
             {'driver': 'LUMIN',   'value': 0, 'uom': 36, 'name': 'Light Level'},  # Lux
             {'driver': 'BATLVL',  'value': 0, 'uom': 72, 'name': 'Battery'},  # battery
+            {'driver': 'GV10',    'value': 0, 'uom': 17, 'name': 'Wet Bulb'},  # wet bulb
+            {'driver': 'GV11',    'value': 0, 'uom': 56, 'name': 'Air Density'},  # air density
+            {'driver': 'GV12',    'value': 0, 'uom': 32, 'name': '2 Minute Wind Speed'},  # 2 min avg speed
+            {'driver': 'GV13',    'value': 0, 'uom': 76, 'name': '2 Minute Wind Direction'},  # 2 min avg direction
+            {'driver': 'GV14',    'value': 0, 'uom': 32, 'name': '10 Minute Wind Speed'},  # 10 min avg speed
+            {'driver': 'GV15',    'value': 0, 'uom': 76, 'name': '10 Minute Wind Direction'},  # 10 min avg direction
+            {'driver': 'GV16',    'value': 0, 'uom': 32, 'name': '10 Minute Peak Gust'},  # 10 min peak gust
+            {'driver': 'GV17',    'value': 0, 'uom': 76, 'name': 'Peak Gust Direction'},  # peak gust direction
+            {'driver': 'GV18',    'value': 0, 'uom': 25, 'name': 'Data Source'},  # UDP, REST or WebSocket
+            {'driver': 'GV19',    'value': 0, 'uom': 56, 'name': 'Strikes 10 Minutes'},  # strike events, 10 min
+            {'driver': 'GV20',    'value': 0, 'uom': 83, 'name': 'Nearest Strike 10 Minutes'},  # nearest, 10 min
+            {'driver': 'GV21',    'value': 0, 'uom': 56, 'name': 'Strikes 30 Minutes'},  # strike events, 30 min
+            {'driver': 'GV22',    'value': 0, 'uom': 83, 'name': 'Nearest Strike 30 Minutes'},  # nearest, 30 min
+            {'driver': 'GV23',    'value': 0, 'uom': 56, 'name': 'Strikes 60 Minutes'},  # strike events, 60 min
+            {'driver': 'GV24',    'value': 0, 'uom': 83, 'name': 'Nearest Strike 60 Minutes'},  # nearest, 60 min
+            {'driver': 'GV25',    'value': -1, 'uom': 45, 'name': 'Minutes Since Strike'},  # -1 until the first strike
 
             ]
     units = {}
+    source_driver = 'GV18'
+    strike_drivers = ('GV19', 'GV20', 'GV21', 'GV22', 'GV23', 'GV24', 'GV25')
 
     def __init__(self, polyglot, primary, address, name):
         super(TempestNode, self).__init__(polyglot, primary, address, name)
 
         self.elevation = 0  # needed for pressure conversion
-        self.trend = []
-        self.prev = datetime.datetime.now()
+        self.metrics = derived.DerivedEngine(self.elevation)
+        self.trend = derived.PressureTrend()
+        self.wind = wind.WindStats()
         self.rd = {
                 'hourly': 0,
                 'daily': 0,
@@ -60,29 +81,16 @@ class TempestNode(udi_interface.Node):
                 'yearly': 0,
                 'yesterday': 0
                 }
+        self.rain = accumulator.RainAccumulator(self.rd)
+        self.rain.node = self
         
-    def rain_update(self, current_rain, force=False):
-        # Update the accumulators and drivers
-        now = datetime.datetime.now()
-        (y, w, d) = now.isocalendar()
-
-        if now.hour != self.prev.hour:
-            self.rd['hourly'] = 0
-        self.rd['hourly'] += current_rain
-        if now.day != self.prev.day:
-            self.rd['yesterday'] = self.rd['daily']
-            self.rd['daily'] = 0
-        self.rd['daily'] += current_rain
-        if w != self.prev.isocalendar()[1]:
-            self.rd['weekly'] = 0
-        self.rd['weekly'] += current_rain
-        if now.month != self.prev.month:
-            self.rd['monthly'] = 0
-        self.rd['monthly'] += current_rain
-        if now.year != self.prev.year:
-            self.rd['yearly'] = 0
-        self.rd['yearly'] += current_rain
+    def InitRain(self, rain):
+        # rain accumulator shared with the nearcast rain node
+        self.rain = rain
+        self.rd = rain.rd
+        rain.node = self
 
+    def rain_publish(self, force=False):
         # convert rain values if neccessary
         if self.units['rain'] == 'in':
             uom = 105  # inches
@@ -101,10 +109,12 @@ class TempestNode(udi_interface.Node):
             self.setDriver('GV8', round(self.rd['yearly'], 3), uom=uom, force=force)
             self.setDriver('GV9', round(self.rd['yesterday'], 3), uom=uom, force=force)
 
-        self.prev = now
-
-    def rapid_wind(self, obs, force=False):
+    def rapid_wind(self, obs, force=False, publish=True):
         tm = obs[0]
+        self.wind.rapid(tm, obs[1], obs[2])
+        if not publish:
+            return
+
         ws = obs[1] * (18 / 5)  # wind speed from m/s to kph
         wd = obs[2]
 
@@ -114,11 +124,40 @@ class TempestNode(udi_interface.Node):
         elif self.units['wind'] == 'kph':
             uom = 32
         else:  # m/s
-            ws = round(wg * 5 / 18, 2)
+            ws = round(ws * 5 / 18, 2)
             uom = 40
         self.setDriver('SPEED', ws, uom=uom, force=force)
         self.setDriver('WINDDIR', wd, force=force)
 
+    def wind_stats_update(self, force=False):
+        # rolling averages and peak gust are kept in m/s
+        if self.units['wind'] == 'mph':
+            factor = 3.6 / 1.609344
+            uom = 48
+        elif self.units['wind'] == 'kph':
+            factor = 3.6
+            uom = 32
+        else:  # m/s
+            factor = 1
+            uom = 40
+
+        (gust, gust_dir) = self.wind.gust.peak()
+        for (spd, drv) in ((self.wind.avg2.speed(), 'GV12'),
+                           (self.wind.avg10.speed(), 'GV14'),
+                           (gust, 'GV16')):
+            if spd is not None:
+                self.setDriver(drv, round(spd * factor, 2), uom=uom, force=force)
+
+        for (wd, drv) in ((self.wind.avg2.direction(), 'GV13'),
+                          (self.wind.avg10.direction(), 'GV15'),
+                          (gust_dir, 'GV17')):
+            if wd is not None:
+                self.setDriver(drv, wd, force=force)
+
+    def SetElevation(self, elevation):
+        self.elevation = elevation
+        self.metrics = derived.DerivedEngine(elevation)
+
     def update(self, obs, force=False):
         # process air data
         try:
@@ -136,6 +175,8 @@ class TempestNode(udi_interface.Node):
             bv = obs[0][16] # battery
             it = obs[0][17] # reporting interval
 
+            self.wind.observation(tm, obs[0][2], obs[0][3], wd)
+
             # convert wind speed from m/s to kph
             if (obs[0][1] is not None):
                 wl = obs[0][1] * (18 / 5) # wind lull
@@ -150,14 +191,17 @@ class TempestNode(udi_interface.Node):
             else:
                 wg = 0
 
-            sl = derived.toSeaLevel(p, self.elevation)
-            trend = derived.updateTrend(p, self.trend)
-            
+            trend = self.trend.update(tm, p)
+
             try:
-                fl = derived.ApparentTemp(t, ws/3.6, h)
-                dp = derived.Dewpoint(t, h)
-                hi = derived.Heatindex(t, h)
-                wc = derived.Windchill(t, ws)
+                m = self.metrics.compute(t, h, ws, p)
+                sl = m.sealevel
+                fl = m.feels_like
+                dp = m.dewpoint
+                hi = m.heatindex
+                wc = m.windchill
+                wb = m.wetbulb
+                ad = m.density
             except Exception as e:
                 LOGGER.error('Failure to calculate Air temps: ' + str(e))
 
@@ -173,6 +217,7 @@ class TempestNode(udi_interface.Node):
             dp = round((dp * 1.8) + 32, 2)  # convert to F
             hi = round((hi * 1.8) + 32, 2)  # convert to F
             wc = round((wc * 1.8) + 32, 2)  # convert to F
+            wb = round((wb * 1.8) + 32, 2)  # convert to F
             uom = 17
         else:
             uom = 4
@@ -181,6 +226,7 @@ class TempestNode(udi_interface.Node):
         self.setDriver('DEWPT', dp, uom=uom, force=force)
         self.setDriver('HEATIX', hi, uom=uom, force=force)
         self.setDriver('WINDCH', wc, uom=uom, force=force)
+        self.setDriver('GV10', wb, uom=uom, force=force)
 
         # pressures p, sl  (conversions)
         if self.units['pressure'] == 'inhg':
@@ -207,9 +253,12 @@ class TempestNode(udi_interface.Node):
         self.setDriver('BATLVL', bv, force=force)
         self.setDriver('GV1', trend, force=force)
         self.setDriver('GV2', ls, force=force)
+        self.setDriver('GV11', ad, force=force)
 
         # ra == mm/minute (or interval)  (conversion necessary)
-        self.rain_update(ra, force)
+        nc = obs[0][19] if len(obs[0]) > 19 else None  # REST only
+        self.rain.add(tm, ra, nc)
+        self.rain.publish(force)
         if self.units['rain'] == 'in':
             uom = 24  # in/hr
             ra = round((ra * 0.03937 * 60), 3)
@@ -246,3 +295,5 @@ class TempestNode(udi_interface.Node):
         self.setDriver('GV3', wd, force=force)
         self.setDriver('BATLVL', bv, force=force)
 
+        self.wind_stats_update(force)
+
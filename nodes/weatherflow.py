@@ -12,6 +12,8 @@ import requests
 import json
 import socket
 import math
+import hashlib
+import os
 import threading
 from nodes import air
 from nodes import sky
@@ -19,10 +21,42 @@ from nodes import tempest
 from nodes import forecast
 from nodes import ncrain
 from nodes import et3
+from nodes import etonode
+from nodes import accumulator
+from nodes import history
+from nodes import archive
+from nodes import columnar
+from nodes import httpapi
+from nodes import actor
+from nodes import dispatch
+from nodes import shard
+from nodes import wsfeed
+from nodes import hub
+from nodes import lightning
 
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
 
+# UDP message type for each device type's observations
+OBS_TYPES = {'AR': 'obs_air', 'SK': 'obs_sky', 'ST': 'obs_st'}
+
+# Where the reporting interval (minutes) is in each device type's obs
+INTERVAL_INDEX = {'AR': 7, 'SK': 9, 'ST': 17}
+
+# Values of the device nodes' data source driver
+SOURCE_UDP = 0
+SOURCE_REST = 1
+SOURCE_WEBSOCKET = 2
+
+# Days of ETo calculated from history at startup
+ETO_DAYS = 7
+
+# Most hourly forecast nodes we'll create
+MAX_HOURLY = 24
+
+# Tries for each month of history before giving up on it
+BACKFILL_TRIES = 3
+
 class Controller(udi_interface.Node):
     def __init__(self, polyglot, primary, address, name):
         super(Controller, self).__init__(polyglot, primary, address, name)
@@ -33,14 +67,34 @@ class Controller(udi_interface.Node):
 
         self.Parameters = Custom(polyglot, 'customparams')
         self.Notices = Custom(polyglot, 'notices')
+        self.CustomData = Custom(polyglot, 'customdata')
+        self.dataLoaded = False
 
         self.deviceList = {}
         self.rainList = {}
         self.ncrainList = {}
+        self.history = {}
+        self.archive = None
+        self.columns = {}   # device id -> columnar.ColumnStore, one per device
+        self.columns_lock = threading.Lock()
+        self.http = None
+        self.hourly_count = 0
         self.isConfigured = False
         self.nodesAdded = 1
         self.nodesCreated = 1
-        self.eto = et3.etO()
+        self.eto = {}       # station id -> et3.etO
+        self.stations = {}  # device serial number -> station id
+        self.timezones = {} # station id -> timezone name
+        self.actors = actor.ActorPool()   # device id or ('eto', station) -> mailbox
+        self.dispatcher = dispatch.Dispatcher()
+        self.shards = None
+        self.ws = None
+        self.obs_lock = threading.Lock()
+        self.status = hub.StatusTracker()
+        self.strikes = lightning.StrikeTracker()
+        self.strike_timers = {}     # device id -> threading.Timer for a held back publish
+        self.strike_lock = threading.Lock()
+        self.stale_intervals = 3
 
         self.stopping = False
         self.stopped = True
@@ -57,6 +111,7 @@ class Controller(udi_interface.Node):
                 'other': 'metric',
                 }
         self.poly.subscribe(self.poly.CUSTOMPARAMS, self.parameterHandler)
+        self.poly.subscribe(self.poly.CUSTOMDATA, self.dataHandler)
         self.poly.subscribe(self.poly.START, self.start, self.address)
         self.poly.subscribe(self.poly.POLL, self.poll)
         self.poly.subscribe(self.poly.ADDNODEDONE, self.nodesDoneHandler)
@@ -66,6 +121,75 @@ class Controller(udi_interface.Node):
     def nodesDoneHandler(self, node):
         self.nodesAdded += 1
 
+    def dataHandler(self, data):
+        self.CustomData.load(data)
+        self.dataLoaded = True
+
+    def profile_hash(self, path='profile'):
+        """
+          Compute a hash of everything in the profile directory.  The
+          relative path of each file is included so that a rename
+          also counts as a change.
+        """
+        h = hashlib.sha256()
+        for root, dirs, files in sorted(os.walk(path)):
+            dirs.sort()
+            for f in sorted(files):
+                fpath = os.path.join(root, f)
+                h.update(os.path.relpath(fpath, path).encode('utf-8'))
+                with open(fpath, 'rb') as pf:
+                    h.update(pf.read())
+        return h.hexdigest()
+
+    def update_profile(self, force=False):
+        """
+          Only send the profile to the ISY if it has changed since the
+          last time we sent it, or if asked to.
+        """
+        try:
+            current = self.profile_hash()
+        except Exception as e:
+            LOGGER.error('Failed to hash profile files: {}'.format(e))
+            current = None
+
+        if not force and current is not None and \
+                self.CustomData['profile_hash'] == current:
+            LOGGER.info('Profile is unchanged, skipping profile update.')
+            return
+
+        LOGGER.info('Updating profile')
+        self.poly.updateProfile()
+        if current is not None:
+            self.CustomData['profile_hash'] = current
+
+    def cmd_update_profile(self, command):
+        self.update_profile(True)
+
+    def http_start(self):
+        """
+          Start, restart or stop the HTTP API to match the HTTPPort
+          parameter.  A port of 0 (the default) turns it off.
+        """
+        try:
+            port = int(self.Parameters['HTTPPort'] or 0)
+        except ValueError:
+            LOGGER.error('Invalid HTTPPort {}'.format(self.Parameters['HTTPPort']))
+            port = 0
+
+        if self.http is not None:
+            if self.http.port == port:
+                return
+            self.http.stop()
+            self.http = None
+
+        if port > 0:
+            try:
+                self.http = httpapi.HttpApi(self, port)
+                self.http.start()
+            except Exception as e:
+                LOGGER.error('Failed to start HTTP API on port {}: {}'.format(port, e))
+                self.http = None
+
     def parameterHandler(self, params):
         """
           Get the parameters that the user entered.  We need the API
@@ -105,12 +229,40 @@ class Controller(udi_interface.Node):
                 continue
             if st == 'Rapid Wind':
                 continue
+            if st == 'HTTPPort':
+                continue
+            if st == 'Hourly Forecast':
+                continue
+            if st == 'Workers':
+                continue
+            if st == 'WebSocket' or st == 'WebSocketURL':
+                continue
+            if st == 'Stale Intervals':
+                continue
 
             if st.isdigit():
                 stationList.append({'id': st, 'remote': self.Parameters[st]})
             else:
                 LOGGER.debug(f'skipping {st} not a valid station id')
 
+        self.http_start()
+
+        try:
+            self.hourly_count = min(max(int(self.Parameters['Hourly Forecast'] or 0), 0), MAX_HOURLY)
+        except ValueError:
+            LOGGER.error('Invalid Hourly Forecast {}'.format(self.Parameters['Hourly Forecast']))
+            self.hourly_count = 0
+        self.remove_hourly_nodes()
+
+        try:
+            self.stale_intervals = max(int(self.Parameters['Stale Intervals'] or 3), 1)
+        except ValueError:
+            LOGGER.error('Invalid Stale Intervals {}'.format(self.Parameters['Stale Intervals']))
+            self.stale_intervals = 3
+
+        if validWind:
+            self.configure_dispatch()
+
         if validToken and len(stationList) > 0 and validWind:
             self.Notices.clear()
             self.isConfigured = True
@@ -127,6 +279,30 @@ class Controller(udi_interface.Node):
                 self.Notices['stations'] = 'Please set Rapid Wind to true or false'
 
 
+    def configure_dispatch(self):
+        """
+          Set up the handlers for the UDP message types we use.  Anything
+          that depends on the configuration is decided here, not for
+          each message.
+        """
+        for msg_type in list(OBS_TYPES.values()) + ['rapid_wind', 'evt_strike', 'hub_status', 'device_status']:
+            self.dispatcher.unregister(msg_type)
+
+        for msg_type in OBS_TYPES.values():
+            self.dispatcher.register(msg_type, self.send_data)
+
+        # Rapid wind is always used for the wind averages, only sent
+        # to the ISY if enabled.
+        if self.Parameters['Rapid Wind'].lower() == 'true':
+            self.dispatcher.register('rapid_wind', self.send_rapid_wind)
+        else:
+            self.dispatcher.register('rapid_wind', self.send_rapid_wind_quiet)
+
+        self.dispatcher.register('evt_strike', self.strike_event)
+
+        self.dispatcher.register('hub_status', self.hub_status)
+        self.dispatcher.register('device_status', self.device_status)
+
     def query_station(self, station):
         path_str = 'https://swd.weatherflow.com'
         path_str += '/swd/rest/stations/' + station 
@@ -163,7 +339,18 @@ class Controller(udi_interface.Node):
         #  jdata['stations'][0]['devices']
         info['name'] = jdata['stations'][0]['name'] 
         info['elevation'] = jdata['stations'][0]['station_meta']['elevation']
+        info['timezone'] = jdata['stations'][0].get('timezone')
         info['devices'] = []
+
+        # Each station gets its own ETo tracker
+        if station not in self.eto:
+            self.eto[station] = et3.etO()
+        tracker = self.eto[station]
+        tracker.elevation = info['elevation']
+        tracker.latitude = jdata['stations'][0]['latitude']
+        tracker.longitude = jdata['stations'][0]['longitude']
+        tracker.day = datetime.datetime.now().timetuple().tm_yday
+
         for d in jdata['stations'][0]['devices']:
             if 'device_type' not in d:
                 continue
@@ -180,13 +367,11 @@ class Controller(udi_interface.Node):
                 rain_type = d['device_type']
                 if d['device_type'] == 'SK' or d['device_type'] == 'ST':
                     rain_id = d['device_id']
-                    self.query_station_rain(station, rain_id, rain_type)
+                    self.query_station_rain(station, rain_id, rain_type, info['timezone'])
 
-                if station == self.Parameters['Forecast']:
-                    self.eto.addDevice(d['serial_number'])
-                    self.eto.elevation = info['elevation']
-                    self.eto.latitude = jdata['stations'][0]['latitude']
-                    self.eto.day = datetime.datetime.now().timetuple().tm_yday
+                if not tracker.isDevice(d['serial_number']):
+                    tracker.addDevice(d['serial_number'])
+                self.stations[d['serial_number']] = station
 
 
         info['units'] = self.query_station_uom(station)
@@ -228,36 +413,104 @@ class Controller(udi_interface.Node):
 
         return units
 
-    def query_station_rain(self, station, rain_id, rain_type):
-
-        # Query server for rain over various time periods.  Currently
-        # this is getting the hub reported rain values.  Howe do we
-        # add NC rain values???
+    def query_station_rain(self, station, rain_id, rain_type, timezone=None):
+        # Rain totals for each period are summed from the device's
+        # column store.  Only the observations the store doesn't have
+        # yet are requested from the server.
         if rain_type == 'SK' or rain_type == 'ST':
-            t_rain, t_rain_nc = self.get_today_rain(rain_id, rain_type)
-            p_rain, p_rain_nc = self.get_yesterday_rain(rain_id, rain_type)
-            w_rain, w_rain_nc = self.get_weekly_rain(rain_id, rain_type)
-            m_rain, y_rain, m_rain_nc, y_rain_nc = self.get_monthly_rain(rain_id, rain_type)
-
-            #self.rain_accumulation(rain_id, p_rain, t_rain, w_rain, m_rain, y_rain)
-            # We have both nc and non-nc values.  Do we send both or only one
-            # based on user preference???
-            self.rainList[rain_id] = {
-                'hourly': 0,
-                'daily': t_rain,
-                'weekly': w_rain,
-                'monthly': m_rain,
-                'yearly': y_rain,
-                'yesterday': p_rain,
-                }
-            self.ncrainList[rain_id] = {
-                'nc_hourly': 0,
-                'nc_daily': t_rain_nc,
-                'nc_weekly': w_rain_nc,
-                'nc_monthly': m_rain_nc,
-                'nc_yearly': y_rain_nc,
-                'nc_yesterday': p_rain_nc
-             }
+            now = int(time.time())
+            bounds = accumulator.Calendar(timezone).boundaries(now)
+            day_start = bounds['daily'][0]
+            yesterday_start = accumulator.Calendar(timezone).boundaries(day_start - 1)['daily'][0]
+            start = min(bounds['yearly'][0], bounds['weekly'][0], yesterday_start)
+
+            store = self.column_store(rain_id)
+            self.backfill_history(store, rain_id, rain_type, int(start), now)
+
+            self.rainList[rain_id] = {}
+            self.ncrainList[rain_id] = {}
+            for p in accumulator.PERIODS:
+                self.rainList[rain_id][p] = store.sum('rain', bounds[p][0], now + 1)
+                self.ncrainList[rain_id]['nc_' + p] = store.sum('rain_nc', bounds[p][0], now + 1)
+            self.rainList[rain_id]['yesterday'] = store.sum('rain', yesterday_start, day_start)
+            self.ncrainList[rain_id]['nc_yesterday'] = store.sum('rain_nc', yesterday_start, day_start)
+
+            LOGGER.info('Rain for {}: {}'.format(rain_id, self.rainList[rain_id]))
+            LOGGER.info('Nearcast rain for {}: {}'.format(rain_id, self.ncrainList[rain_id]))
+
+    def column_store(self, device_id):
+        # Backfill and live updates run on different threads, they must
+        # share the one store that has the device's files mapped.
+        with self.columns_lock:
+            if device_id not in self.columns:
+                self.columns[device_id] = columnar.ColumnStore(os.path.join('columns', str(device_id)))
+            return self.columns[device_id]
+
+    def backfill_history(self, store, device_id, device_type, start, end):
+        """
+          Fill the column store with observations from start to end,
+          requesting only what it doesn't already have.
+        """
+        if store.origin() == 0 or store.origin() > start:
+            # Observations can only be appended, start over
+            LOGGER.info('History for {} starts after {}, reloading'.format(device_id, start))
+            store.clear(start)
+        elif len(store) > 0:
+            start = max(start, store.last() + 1)
+
+        # One request per month, like the server's own history queries
+        while start < end:
+            chunk_end = min(start + 31 * 86400, end)
+            for attempt in range(BACKFILL_TRIES):
+                obs = self.get_observations(device_id, start, chunk_end)
+                if obs is not None:
+                    break
+                time.sleep(5 * (attempt + 1))
+            if obs is None:
+                # The store is append only and the next start resumes
+                # after the newest row, so this range can't be filled
+                # in later.  Carry on with the rest.
+                LOGGER.warning('History for {} from {} to {} is missing, the server query failed'.format(
+                    device_id, start, chunk_end))
+                start = chunk_end
+                continue
+
+            decoded = []
+            for ob in obs:
+                try:
+                    o = history.decode(device_type, ob)
+                except Exception as e:
+                    LOGGER.debug('Failed to decode observation: {}'.format(e))
+                    continue
+                if o is not None:
+                    decoded.append(o)
+            decoded.sort(key=lambda o: o.timestamp)
+            count = store.append(decoded)
+            LOGGER.info('Loaded {} observations for {} from {} to {}'.format(count, device_id, start, chunk_end))
+            start = chunk_end
+
+    def get_observations(self, device_id, start, end):
+        #  /swd/rest/observations/device/<id>?time_start=start&time_end=end&api_key=
+        path_str = 'https://swd.weatherflow.com'
+        path_str += '/swd/rest/observations/device/'
+        path_str += str(device_id) + '?'
+        path_str += 'time_start=' + str(int(start))
+        path_str += '&time_end=' + str(int(end))
+        path_str += '&api_key=' + self.Parameters.Token
+
+        LOGGER.info('path = ' + path_str)
+
+        try:
+            c = requests.get(path_str)
+            awdata = c.json()
+            c.close()
+        except Exception as e:
+            LOGGER.error('Failed to get observations for {}: {}'.format(device_id, e))
+            return None
+
+        if awdata.get('obs') is None:
+            return []
+        return awdata['obs']
 
     def query_device(self, device_id):
         path_str = 'https://swd.weatherflow.com'
@@ -279,14 +532,58 @@ class Controller(udi_interface.Node):
                     LOGGER.error('Error querying device {}:'.format(device_id, jdata['status']['status_message']))
                     return None
 
+        obs = self.new_observations(device_id, jdata.get('obs') or [], SOURCE_REST)
+        if len(obs) == 0:
+            return
+
+        if self.shards is not None:
+            self.shards.observation(self.deviceList[device_id]['serial_number'], obs, False)
+        else:
+            self.actors.submit(device_id, self.update_device, device_id, obs, False)
+
+        device = self.deviceList[device_id]
+        station = self.stations.get(device['serial_number'])
+        if station is not None and device['type'] in OBS_TYPES:
+            self.actors.submit(('eto', station), self.eto[station].addData,
+                    {'type': OBS_TYPES[device['type']], 'obs': obs})
+
+    def new_observations(self, device_id, obs, source):
+        """
+          The same observation can arrive by UDP, REST and the WebSocket
+          feed.  Return only the ones newer than what we already have
+          and keep track of where the device's data is coming from.
+        """
+        device = self.deviceList[device_id]
+        with self.obs_lock:
+            obs = [ob for ob in obs if len(ob) > 0 and ob[0] is not None and ob[0] > device['last_ts']]
+            if len(obs) == 0:
+                return obs
+
+            newest = max(obs, key=lambda ob: ob[0])
+            device['last_ts'] = newest[0]
+            idx = INTERVAL_INDEX.get(device['type'])
+            if idx is not None and idx < len(newest) and newest[idx]:
+                device['interval'] = newest[idx]
+            if source == SOURCE_UDP:
+                device['udp_seen'] = time.time()
+            changed = device['source'] != source
+            device['source'] = source
+
+        if changed:
+            LOGGER.info('Device {} data is now from {}'.format(device_id, ('UDP', 'REST', 'WebSocket')[source]))
+            self.actors.submit(device_id, self.publish_source, device_id, source)
+        return obs
+
+    def publish_source(self, device_id, source):
         node = self.poly.getNode(device_id)
-        node.update(jdata['obs'], False)
+        if node is not None and hasattr(node, 'source_driver'):
+            node.setDriver(node.source_driver, source, True, False, 25)
 
-        # Update nearcast rain
-        node = self.poly.getNode(str(device_id) + '_nc')
-        node.update(jdata['obs'], False)
+    def udp_stale(self, device):
+        """ True if a local device missed Stale Intervals reports """
+        return time.time() - device['udp_seen'] > self.stale_intervals * device['interval'] * 60
 
-    def create_device_node(self, station, device, units, elevation):
+    def create_device_node(self, station, device, units, elevation, timezone=None):
         """
           Create a device node.  There are 3 types of nodes:
             Tempest:
@@ -304,13 +601,14 @@ class Controller(udi_interface.Node):
             LOGGER.info('Add AIR device node {}'.format(device['serial_number']))
             node = air.AirNode(self.poly, self.address, device['device_id'], device['serial_number'])
             # TODO: do we need to account for agl too?
-            node.elevation = elevation
+            node.SetElevation(elevation)
             node.units = units
             self.poly.addNode(node)
         elif device['device_type'] == 'SK':
             LOGGER.info('Add SKY device node {}'.format(device['serial_number']))
             node = sky.SkyNode(self.poly, self.address, device['device_id'], device['serial_number'])
-            node.rd = self.rainList[device['device_id']]
+            rain = accumulator.RainAccumulator(self.rainList[device['device_id']], self.ncrainList[device['device_id']], timezone)
+            node.InitRain(rain)
             node.units = units
             self.poly.addNode(node)
 
@@ -318,16 +616,16 @@ class Controller(udi_interface.Node):
                 LOGGER.info('Creating node for nearcast rain values...')
                 self.nodesCreated += 1
                 node = ncrain.NCRainNode(self.poly, self.address, str(device['device_id']) + '_nc', str(device['serial_number']) + '_nc')
-                node.rd = self.ncrainList[device['device_id']]
+                node.InitRain(rain)
                 node.units = units
-                node.device_type = device['device_type']
                 self.poly.addNode(node)
         elif device['device_type'] == 'ST':
             LOGGER.info('Add Tempest device node {}'.format(device['serial_number']))
             node = tempest.TempestNode(self.poly, self.address, device['device_id'], device['serial_number'])
             # TODO: do we need to account for agl too?
-            node.elevation = elevation
-            node.rd = self.rainList[device['device_id']]
+            node.SetElevation(elevation)
+            rain = accumulator.RainAccumulator(self.rainList[device['device_id']], self.ncrainList[device['device_id']], timezone)
+            node.InitRain(rain)
             node.units = units
             self.poly.addNode(node)
 
@@ -335,172 +633,14 @@ class Controller(udi_interface.Node):
                 LOGGER.info('Creating node for nearcast rain values...')
                 self.nodesCreated += 1
                 node = ncrain.NCRainNode(self.poly, self.address, str(device['device_id']) + '_nc', str(device['serial_number']) + '_nc')
-                node.rd = self.ncrainList[device['device_id']]
+                node.InitRain(rain)
                 node.units = units
-                node.device_type = device['device_type']
                 self.poly.addNode(node)
         else:
             return
 
         self.nodesCreated += 1
 
-    # Get observations data for each month of the year, so far
-    def get_monthly_rain(self, device_id, device_type):
-        # Do month by month query of rain info.
-        today = datetime.datetime.today()
-        y_rain = 0
-        y_rain_nc = 0
-        m_rain = 0
-        m_rain_nc = 0
-        for month in range(1, today.month+1):
-            try:
-                m_rain = 0
-                m_rain_nc = 0
-                # get epoch time for start of month and end of month
-                try:
-                    datem = datetime.datetime(today.year, month, 1)
-                    start_date = datem.replace(day=1)
-                    if month == 12:
-                        end_date = datem.replace(month=12, day=31)
-                    else:
-                        end_date = datem.replace(month=(month+1 % 12), day=1)
-                except Exception as e:
-                    LOGGER.error(f'Problem with dates: {e}')
-                    continue
-
-                # make request:
-                #  /swd/rest/observations/device/<id>?time_start=start&time_end=end&api_key=
-                path_str = 'https://swd.weatherflow.com'
-                path_str += '/swd/rest/observations/device/'
-                path_str += str(device_id) + '?'
-                path_str += 'time_start=' + str(int(start_date.timestamp()))
-                path_str += '&time_end=' + str(int(end_date.timestamp()))
-                path_str += '&api_key=' + self.Parameters.Token
-
-                LOGGER.info('path = ' + path_str)
-
-                c = requests.get(path_str)
-                awdata = c.json()
-
-                # we should now have an array of observations
-                for obs in awdata['obs']:
-                    # for sky, index 3 is daily rain.  for tempest it is index 12
-                    m_rain += obs[3] if device_type == 'SK' else obs[12]
-                    m_rain_nc += obs[14] if device_type == 'SK' else obs[19]
-                    y_rain += obs[3] if device_type == 'SK' else obs[12]
-                    y_rain_nc += obs[14] if device_type == 'SK' else obs[19]
-
-                LOGGER.info('Month {} had rain = {}, nearcast = {}'.format(month, m_rain, m_rain_nc))
-
-                c.close()
-            except:
-                LOGGER.error('Failed to get rain for month %d' % month);
-                c.close()
-
-        LOGGER.info('Year had rain = {}, nearcast = {}'.format(y_rain, y_rain_nc))
-
-        return m_rain, y_rain, m_rain_nc, y_rain_nc
-
-    # Get observations data for past week
-    def get_weekly_rain(self, device_id, device_type):
-        # Need to do a separate query for weekly rain
-        today = datetime.datetime.today()
-        start_date = today - datetime.timedelta(days=7)
-        end_date = today
-        path_str = 'https://swd.weatherflow.com'
-        path_str += '/swd/rest/observations/device/'
-        path_str += str(device_id) + '?'
-        path_str += 'time_start=' + str(int(start_date.timestamp()))
-        path_str += '&time_end=' + str(int(end_date.timestamp()))
-        path_str += '&api_key=' + self.Parameters.Token
-
-        LOGGER.info('path = ' + path_str)
-
-        w_rain = 0
-        w_rain_nc = 0
-        try:
-            c = requests.get(path_str)
-            awdata = c.json()
-            w_rain = 0
-            for obs in awdata['obs']:
-                w_rain += obs[3] if device_type == 'SK' else obs[12]
-                w_rain_nc += obs[14] if device_type == 'SK' else obs[19]
-
-            c.close()
-        except:
-            LOGGER.error('Failed to get weekly rain')
-            c.close()
-
-        LOGGER.info('weekly rain total = ' + str(w_rain))
-
-        return w_rain, w_rain_nc
-
-    def get_yesterday_rain(self, device_id, device_type):
-        today = datetime.datetime.today()
-        start_date = today - datetime.timedelta(days=1)
-        start_date = datetime.datetime.combine(start_date, datetime.datetime.min.time())
-        end_date = datetime.datetime.combine(today, datetime.datetime.min.time())
-        path_str = 'https://swd.weatherflow.com'
-        path_str += '/swd/rest/observations/device/'
-        path_str += str(device_id) + '?'
-        path_str += 'time_start=' + str(int(start_date.timestamp()))
-        path_str += '&time_end=' + str(int(end_date.timestamp()))
-        path_str += '&api_key=' + self.Parameters.Token
-
-        LOGGER.info('path = ' + path_str)
-
-        y_rain = 0
-        y_rain_nc = 0
-        try:
-            c = requests.get(path_str)
-            awdata = c.json()
-            y_rain = 0
-            for obs in awdata['obs']:
-                y_rain += obs[3] if device_type == 'SK' else obs[12]
-                y_rain_nc += obs[14] if device_type == 'SK' else obs[19]
-
-            c.close()
-        except:
-            LOGGER.error('Failed to get yesterday rain')
-            c.close()
-
-        LOGGER.info('yesterday rain total = ' + str(y_rain))
-
-        return y_rain, y_rain_nc
-
-    def get_today_rain(self, device_id, device_type):
-        today = datetime.datetime.today()
-        start_date = datetime.datetime.combine(today, datetime.datetime.min.time())
-        end_date = today
-        path_str = 'https://swd.weatherflow.com'
-        path_str += '/swd/rest/observations/device/'
-        path_str += str(device_id) + '?'
-        path_str += 'time_start=' + str(int(start_date.timestamp()))
-        path_str += '&time_end=' + str(int(end_date.timestamp()))
-        path_str += '&api_key=' + self.Parameters.Token
-
-        LOGGER.info('path = ' + path_str)
-
-        rain_today = 0
-        rain_today_nc = 0
-        try:
-            c = requests.get(path_str)
-            awdata = c.json()
-            t_rain = 0
-            for obs in awdata['obs']:
-                rain_today += obs[3] if device_type == 'SK' else obs[12]
-                rain_today_nc += obs[14] if device_type == 'SK' else obs[19]
-
-            c.close()
-        except:
-            LOGGER.error('Failed to get today rain')
-            c.close()
-            return 0, 0
-
-        LOGGER.info('today rain total = ' + str(t_rain))
-        return rain_today, rain_today_nc
-
-
     #### No longer used
     def rain_accumulation(self, device, p_rain, d_rain, w_rain, m_rain, y_rain):
         rd = {
@@ -516,7 +656,15 @@ class Controller(udi_interface.Node):
 
     def start(self):
         LOGGER.info('Starting WeatherFlow Node Server')
-        self.poly.updateProfile()
+
+        # Custom data holds the hash of the last profile we sent. Give
+        # it a chance to arrive before deciding if we need to send it.
+        wait = 0
+        while not self.dataLoaded and wait < 10:
+            time.sleep(1)
+            wait += 1
+
+        self.update_profile()
         self.poly.setCustomParamsDoc()
 
         while not self.isConfigured:
@@ -527,11 +675,22 @@ class Controller(udi_interface.Node):
             # wait for all nodes to be added
             time.sleep(10)
 
+        try:
+            self.archive = archive.Archive()
+            self.archive.start()
+        except Exception as e:
+            LOGGER.error('Failed to open observation archive: {}'.format(e))
+            self.archive = None
+
+        self.shard_start()
+
         LOGGER.info('Starting thread for UDP data')
         self.udp = threading.Thread(target = self.udp_data)
         self.udp.daemon = True
         self.udp.start()
 
+        self.ws_start()
+
         #TODO: forecast is for a station, which station should we use?
         self.forecast_query(self.Parameters['Forecast'], True)
 
@@ -548,28 +707,64 @@ class Controller(udi_interface.Node):
             return
 
         if polltype == 'shortPoll':
-            for device in self.deviceList:
-                if self.deviceList[device]['remote']:
-                    LOGGER.info('TODO: REST query for device {}'.format(device))
+            for device in list(self.deviceList):
+                info = self.deviceList[device]
+                if info['remote']:
+                    if self.ws is not None and self.ws.fresh(device):
+                        continue
+                    LOGGER.info('REST query for device {}'.format(device))
                     self.query_device(device)
-            if self.eto.day != datetime.datetime.now().timetuple().tm_yday:
-                eto = self.eto.doETo()
-                # Value returned is in mm/day.  If self.units['rain'] == 'in'
-                # then we need to convert this to inches/day.
-                LOGGER.info('Yesterday\'s ETo = {}'.format(eto))
-                if self.units['rain'] == 'in':
-                    uom = 120
-                    eto = round(eto * 0.03937, 3)
-                else:
-                    uom = 106
-                self.setDriver('ETO', round(eto, 3), uom=uom)
-                self.eto.reset(datetime.datetime.now().timetuple().tm_yday)
+                elif self.udp_stale(info):
+                    # Hub isn't sending, get the data from the server
+                    # until it starts again.
+                    LOGGER.warning('No UDP data from {} for {} minutes, using REST'.format(
+                        device, int((time.time() - info['udp_seen']) / 60)))
+                    self.query_device(device)
+            today = datetime.datetime.now().timetuple().tm_yday
+            for station, tracker in list(self.eto.items()):
+                if tracker.day != today:
+                    self.actors.submit(('eto', station), self.rollover_eto, station, today)
 
             self.set_hub_timestamp()
+
+            # Seconds since seen changes all the time, it's only updated
+            # this often.  The other values keep their own rate limit.
+            for serial in list(self.status.serials):
+                self.actors.submit_latest(hub.address(serial), self.publish_age, serial)
+
+            # Expire old strikes and update the minutes since the last one
+            for device_id in self.strikes.device_ids():
+                self.actors.submit_latest(device_id, self.publish_strikes, device_id)
         else:
             self.heartbeat()
             self.forecast_query(self.Parameters['Forecast'], False)
 
+    def rollover_eto(self, station, today):
+        tracker = self.eto[station]
+        if tracker.day == today:
+            return
+        eto = tracker.doETo()
+        tracker.daily.append(eto)
+        self.publish_eto(station, eto)
+        tracker.reset(today)
+
+    def publish_eto(self, station, eto):
+        week = sum(self.eto[station].daily)
+        LOGGER.info('Yesterday\'s ETo for {} = {}, last 7 days = {}'.format(station, eto, week))
+        node = self.poly.getNode('eto_' + station)
+        if node is not None:
+            node.publish(eto, week)
+
+        if station == self.Parameters['Forecast']:
+            # Value is in mm/day.  If self.units['rain'] == 'in'
+            # then we need to convert this to inches/day.
+            if self.units['rain'] == 'in':
+                uom = 120
+                eto = round(eto * 0.03937, 3)
+            else:
+                uom = 106
+            self.setDriver('ETO', round(eto, 3), uom=uom)
+
     def query(self):
         for node in self.poly.nodes():
             node.reportDrivers()
@@ -586,13 +781,20 @@ class Controller(udi_interface.Node):
             if info is not None:
                 LOGGER.info('{} has {} devices.'.format(station['id'], len(info['devices'])))
                 self.units = info['units']
+                self.timezones[str(station['id'])] = info['timezone']
                 for device in info['devices']:
                     remote = False
                     if station['remote'].lower() == 'remote':
                         remote = True
                     device['remote'] = remote
-                    self.create_device_node(station['id'], device, info['units'], info['elevation'])
-                    self.deviceList[device['device_id']] = {'serial_number': device['serial_number'], 'type': device['device_type'], 'remote': remote, 'first': True}
+                    self.create_device_node(station['id'], device, info['units'], info['elevation'], info['timezone'])
+                    self.deviceList[device['device_id']] = {'serial_number': device['serial_number'], 'type': device['device_type'], 'remote': remote, 'first': True,
+                            'units': info['units'], 'elevation': info['elevation'], 'timezone': info['timezone'],
+                            'last_ts': 0, 'interval': 1, 'udp_seen': time.time(),
+                            'source': SOURCE_REST if remote else SOURCE_UDP}
+                    self.shard_device(device['device_id'])
+                self.create_eto_node(station['id'], info)
+                self.backfill_eto(station['id'], info)
 
         if self.Parameters['Forecast'] != 0:
             for day in range(0, 10):
@@ -601,7 +803,7 @@ class Controller(udi_interface.Node):
                 try:
                     if not self.poly.getNode(address):
                         node = forecast.ForecastNode(self.poly, self.address, address, title)
-                        node.SetUnits(self.units['temperature'])
+                        node.SetUnits(self.units)
                         self.poly.addNode(node)
                         self.nodesCreated += 1
                 except Excepton as e:
@@ -647,6 +849,104 @@ class Controller(udi_interface.Node):
 
 
 
+    def backfill_eto(self, station, info, days=ETO_DAYS):
+        """
+          Calculate the ETo for each of the last few days from the
+          stored history, fetching anything that's missing, so that
+          yesterday's value and the 7 day total are available now
+          instead of after a full day of live data.
+        """
+        tracker = self.eto.get(station)
+        if tracker is None or len(tracker.daily) > 0:
+            return
+
+        today = datetime.date.today()
+        bounds = [datetime.datetime.combine(today - datetime.timedelta(days=n), datetime.time(0)).timestamp()
+                  for n in range(days, -1, -1)]
+
+        stores = []
+        for device in info['devices']:
+            store = self.column_store(device['device_id'])
+            self.backfill_history(store, device['device_id'], device['device_type'], int(bounds[0]), int(time.time()))
+            stores.append(store)
+
+        columns = {'temperature': [], 'humidity': [], 'wind_avg': [], 'solar_radiation': []}
+        valid = []
+        for d in range(days):
+            start, end = bounds[d], bounds[d + 1]
+            values = {}
+            for field in ('temperature', 'humidity', 'wind_avg'):
+                values[field] = [v for store in stores for v in store.values(field, start, end) if v == v]
+            if not values['temperature'] or not values['humidity'] or not values['wind_avg']:
+                continue
+
+            valid.append(datetime.date.fromtimestamp(start).timetuple().tm_yday)
+            columns['temperature'].append((max(values['temperature']), min(values['temperature'])))
+            columns['humidity'].append((max(values['humidity']), min(values['humidity'])))
+            columns['wind_avg'].append(sum(values['wind_avg']) / len(values['wind_avg']))
+            # Measured radiation has to cover most of the day to be used
+            sr, covered = self.history_radiation(stores, start, end)
+            if covered >= (end - start) * et3.RADIATION_COVERAGE:
+                columns['solar_radiation'].append(sr)
+            else:
+                LOGGER.info('Solar radiation for {} on {} only covers {:.0f}% of the day, using an estimate'.format(
+                    station, datetime.date.fromtimestamp(start), 100 * covered / (end - start)))
+                columns['solar_radiation'].append(None)
+
+        if not valid:
+            LOGGER.info('No history to calculate ETo for {}'.format(station))
+            return
+
+        eto = et3.evapotranspiration_days(
+                [t[0] for t in columns['temperature']], [t[1] for t in columns['temperature']],
+                columns['solar_radiation'], columns['wind_avg'], tracker.elevation,
+                [h[0] for h in columns['humidity']], [h[1] for h in columns['humidity']],
+                tracker.latitude, tracker.canopy, valid)
+
+        yesterday = valid[-1] == (today - datetime.timedelta(days=1)).timetuple().tm_yday
+        self.actors.submit(('eto', station), self.seed_eto, station, [float(v) for v in eto], yesterday)
+
+    def history_radiation(self, stores, start, end):
+        """
+          Mean solar radiation from start to end and the seconds it
+          covers, from the device that covers the most.  History from
+          the server can be 1 minute to 3 hour rows, so each row counts
+          for the store's usual row spacing.
+        """
+        best = (None, 0)
+        for store in stores:
+            times = list(store.values('ts', start, end))
+            spacings = sorted(b - a for a, b in zip(times, times[1:]) if b > a)
+            spacing = spacings[len(spacings) // 2] if spacings else 60
+            sr = [v for v in store.values('solar_radiation', start, end) if v == v]
+            covered = min(len(sr) * spacing, end - start)
+            if covered > best[1]:
+                best = (sum(sr) / len(sr), covered)
+        return best
+
+    def seed_eto(self, station, values, yesterday):
+        tracker = self.eto[station]
+        if len(tracker.daily) > 0:
+            return
+        tracker.daily.extend(values)
+        LOGGER.info('ETo for {} from history: {}'.format(station, list(tracker.daily)))
+
+        # Only seed yesterday's value if we have yesterday
+        if yesterday:
+            self.publish_eto(station, tracker.daily[-1])
+
+    def create_eto_node(self, station, info):
+        address = 'eto_' + station
+        if self.poly.getNode(address) is not None:
+            return
+        try:
+            node = etonode.EToNode(self.poly, self.address, address, info['name'] + ' ETo')
+            node.units = info['units']
+            self.poly.addNode(node)
+            self.nodesCreated += 1
+        except Exception as e:
+            LOGGER.error('Failed to create ETo node for {}: {}'.format(station, e))
+
     def forecast_query(self, station, force=False):
 
         if station is None or station == 0:
@@ -655,6 +955,7 @@ class Controller(udi_interface.Node):
         #  https://swd.weatherflow.com/swd/rest/better_forecast?station_id={}&api_key={}&lat={}&lon={} 
         path_str = 'https://swd.weatherflow.com/swd/rest/better_forecast?'
         path_str += 'station_id=' + str(station)
+        path_str += '&units_temp=c&units_wind=mps'
         path_str += '&api_key=' + self.Parameters['Token']
         try:
             c = requests.get(path_str)
@@ -676,26 +977,51 @@ class Controller(udi_interface.Node):
             daily = jdata['forecast']['daily']
             LOGGER.debug(daily)
 
-            # focus on passing daily data to forecast nodes
-            day = 0
-            for forecast in daily:
-                address = 'forecast_' + str(day)
-                LOGGER.debug(' >>>>   period ' + str(forecast['day_start_local']) + '  ' + address)
-                LOGGER.debug(forecast)
+            # The forecast station may not be one of ours, its
+            # timezone comes with the forecast
+            timezone = jdata.get('timezone') or self.timezones.get(str(station))
 
-                # call node update with forecast
-                node = self.poly.getNode(address)
+            # focus on passing daily data to forecast nodes
+            for day, record in enumerate(forecast.parse_daily(daily, timezone)):
+                node = self.poly.getNode('forecast_' + str(day))
                 if node is not None:
-                    node.update(forecast, force)
-
-                day += 1
-                #if day >= int(self.params.get('Forecast Days')):
-                #    return
+                    node.update(record, force)
+
+            # The hourly forecast comes with the same data
+            if self.hourly_count > 0:
+                hourly = forecast.parse_hourly(jdata['forecast'].get('hourly', []), self.hourly_count)
+                for hour, record in enumerate(hourly):
+                    node = self.poly.getNode('hourly_' + str(hour))
+                    if node is None:
+                        node = self.create_hourly_node(hour)
+                    if node is not None:
+                        node.update(record, force)
 
         except Exception as e:
             LOGGER.error(str(e))
 
 
+    def create_hourly_node(self, hour):
+        # Hourly nodes are only created once we have a forecast for them
+        address = 'hourly_' + str(hour)
+        try:
+            node = forecast.HourlyForecastNode(self.poly, self.address, address, 'Forecast Hour ' + str(hour))
+            node.SetUnits(self.units)
+            self.poly.addNode(node)
+            self.nodesCreated += 1
+            return node
+        except Exception as e:
+            LOGGER.error('Failed to create hourly forecast node {}: {}'.format(address, e))
+            return None
+
+    def remove_hourly_nodes(self):
+        # Remove nodes for hours past the number configured
+        for hour in range(self.hourly_count, MAX_HOURLY):
+            address = 'hourly_' + str(hour)
+            if self.poly.getNode(address) is not None:
+                LOGGER.info('Removing hourly forecast node {}'.format(address))
+                self.poly.delNode(address)
+
     def heartbeat(self):
         LOGGER.debug('heartbeat hb={}'.format(self.hb))
         if self.hb == 0:
@@ -724,6 +1050,19 @@ class Controller(udi_interface.Node):
 
     def stop(self):
         self.stopping = True
+        if self.archive is not None:
+            self.archive.stop()
+        if self.http is not None:
+            self.http.stop()
+        if self.ws is not None:
+            self.ws.stop()
+            self.ws = None
+        if self.shards is not None:
+            self.shards.stop()
+            self.shards = None
+        self.cancel_strike_timers()
+        self.actors.wait(5)
+        self.actors.stop()
         LOGGER.debug('Stopping WeatherFlow node server.')
 
     def remove_notices_all(self,command):
@@ -731,29 +1070,286 @@ class Controller(udi_interface.Node):
         # Remove all existing notices
         self.removeNoticesAll()
 
+    def accepts(self, device, data):
+        # UDP data is used for local devices, the WebSocket feed for remote ones
+        if data.get('source') == 'websocket':
+            return device['remote']
+        return not device['remote']
+
     def send_data(self, data):
-        for d in self.deviceList:
+        for d in list(self.deviceList):
             device = self.deviceList[d]
             if device['serial_number'] == data['serial_number']:
-                if not device['remote']:
-                    node = self.poly.getNode(d)
-                    node.update(data['obs'], device['first'])
-                    device['first'] = False
+                if self.accepts(device, data):
+                    source = SOURCE_WEBSOCKET if data.get('source') == 'websocket' else SOURCE_UDP
+                    obs = self.new_observations(d, data['obs'], source)
+                    if len(obs) == 0:
+                        continue
+
+                    if self.shards is not None:
+                        self.shards.observation(data['serial_number'], obs)
+                    else:
+                        self.actors.submit(d, self.update_device, d, obs, None)
+
+                    station = self.stations.get(data['serial_number'])
+                    if station is not None:
+                        self.actors.submit(('eto', station), self.eto[station].addData, dict(data, obs=obs))
                 else:
-                    LOGGER.debug('device {} not local, ignore UDP data.'.format(d))
+                    LOGGER.debug('device {} ignoring {} data.'.format(d, data.get('source', 'UDP')))
+
+    def update_device(self, device_id, obs, force):
+        """
+          Update a device node with new observations.  Runs in the
+          device's mailbox.  With force None, the first update after
+          startup is forced.
+        """
+        device = self.deviceList[device_id]
+        if force is None:
+            force = device['first']
+            device['first'] = False
+        node = self.poly.getNode(device_id)
+        if node is not None:
+            node.update(obs, force)
+        self.record_history(device_id, obs)
 
-        if self.eto.isDevice(data['serial_number']):
-            self.eto.addData(data)
+    def update_rapid_wind(self, device_id, ob, publish):
+        # The node may not be created yet, and Air nodes have no wind
+        node = self.poly.getNode(device_id)
+        if node is not None and hasattr(node, 'rapid_wind'):
+            node.rapid_wind(ob, publish=publish)
 
-    def send_rapid_wind(self, data):
-        for d in self.deviceList:
+    def record_history(self, device_id, obs):
+        decoded = []
+        for ob in obs:
+            try:
+                o = history.decode(self.deviceList[device_id]['type'], ob)
+            except Exception as e:
+                LOGGER.debug('Failed to decode observation: {}'.format(e))
+                continue
+            if o is not None:
+                decoded.append(o)
+        self.record_decoded(device_id, decoded)
+
+    def record_decoded(self, device_id, decoded):
+        if device_id not in self.history:
+            self.history[device_id] = history.DeviceHistory()
+
+        for o in decoded:
+            self.history[device_id].append(o)
+            if self.archive is not None:
+                self.archive.add(device_id, o)
+
+        try:
+            self.column_store(device_id).append(decoded)
+        except Exception as e:
+            LOGGER.error('Failed to save observations for {}: {}'.format(device_id, e))
+
+    def ws_start(self):
+        """
+          Subscribe to the WebSocket feed for the remote devices if the
+          WebSocket parameter is true.  REST is still used for any
+          device the feed isn't delivering.
+        """
+        if self.ws is not None or (self.Parameters['WebSocket'] or '').lower() != 'true':
+            return
+
+        devices = {d: info['serial_number'] for d, info in list(self.deviceList.items()) if info['remote']}
+        if len(devices) == 0:
+            LOGGER.info('No remote devices, not using the WebSocket feed')
+            return
+
+        self.ws = wsfeed.WSFeed(self.Parameters['WebSocketURL'] or wsfeed.DEFAULT_URL,
+                self.Parameters['Token'], devices, self.dispatcher.dispatch)
+        self.ws.start()
+
+    def shard_start(self):
+        """
+          Start the worker processes if the Workers parameter is set.
+          With 0 (the default) everything is done in this process.
+          Changing it takes effect the next time the node server starts.
+        """
+        try:
+            workers = int(self.Parameters['Workers'] or 0)
+        except ValueError:
+            LOGGER.error('Invalid Workers {}'.format(self.Parameters['Workers']))
+            workers = 0
+        if workers <= 0 or self.shards is not None:
+            return
+
+        try:
+            self.shards = shard.ShardPool(workers, self.apply_shard)
+        except Exception as e:
+            LOGGER.error('Failed to start {} workers: {}'.format(workers, e))
+            self.shards = None
+            return
+
+        for d in list(self.deviceList):
+            self.shard_device(d)
+
+    def shard_device(self, device_id):
+        # Give the device's worker what it needs to keep a copy of the node
+        if self.shards is None:
+            return
+        device = self.deviceList[device_id]
+        self.shards.add_device(device['serial_number'], {
+                'device_id': device_id,
+                'type': device['type'],
+                'units': device['units'],
+                'elevation': device['elevation'],
+                'timezone': device['timezone'],
+                'rd': dict(self.rainList.get(device_id, {})),
+                'nc_rd': dict(self.ncrainList.get(device_id, {})),
+                'nc': device['remote'],
+                })
+
+    def apply_shard(self, deltas, observations):
+        """ Pass driver changes and observations from the workers on """
+        nodes = {}
+        for (address, driver, value, uom, force) in deltas:
+            nodes.setdefault(address, []).append((driver, value, uom, force))
+        for address, drivers in nodes.items():
+            self.actors.submit(address, self.publish_drivers, address, drivers)
+
+        for device_id, packed in observations:
+            decoded = [shard.unpack(p) for p in packed]
+            self.actors.submit(device_id, self.record_decoded, device_id, decoded)
+            self.actors.submit(device_id, self.wind_observations, device_id, decoded)
+
+    def wind_observations(self, device_id, decoded):
+        # The workers have the real wind statistics, keep the ones /wind
+        # reads from this node up to date too.
+        node = self.poly.getNode(device_id)
+        if node is not None and hasattr(node, 'wind'):
+            for o in decoded:
+                node.wind.observation(o.timestamp, o.wind_avg, o.wind_gust, o.wind_dir)
+
+    def rapid_wind_stats(self, device_id, ob):
+        node = self.poly.getNode(device_id)
+        if node is not None and hasattr(node, 'wind'):
+            node.wind.rapid(ob[0], ob[1], ob[2])
+
+    def publish_drivers(self, address, drivers):
+        node = self.poly.getNode(address)
+        if node is None:
+            return
+        for (driver, value, uom, force) in drivers:
+            node.setDriver(driver, value, True, force, uom)
+
+    def strike_event(self, data):
+        """
+          Lightning strike, evt is [epoch, distance (km), energy].
+          These are published as they arrive, not at the next
+          observation.
+        """
+        evt = data.get('evt')
+        if not evt or len(evt) < 2 or evt[0] is None or evt[1] is None:
+            return
+        for d in list(self.deviceList):
             device = self.deviceList[d]
             if device['serial_number'] == data['serial_number']:
-                if not device['remote']:
-                    node = self.poly.getNode(d)
-                    node.rapid_wind(data['ob'])
+                if self.accepts(device, data):
+                    wait = self.strikes.add(d, evt[0], evt[1], time.time())
+                    if wait == 0:
+                        self.actors.submit_latest(d, self.publish_strikes, d)
+                    elif wait is not None:
+                        # More strikes, publish them once the rate limit allows
+                        self.strike_timer(d, wait)
                 else:
-                    LOGGER.debug('device {} not local, ignore UDP data.'.format(d))
+                    LOGGER.debug('device {} ignoring {} data.'.format(d, data.get('source', 'UDP')))
+
+    def strike_timer(self, device_id, wait):
+        """ Publish the device's strikes in wait seconds, one timer per device """
+        with self.strike_lock:
+            if device_id in self.strike_timers or self.stopping:
+                return
+            t = threading.Timer(wait, self.strike_timer_done, (device_id,))
+            t.daemon = True
+            self.strike_timers[device_id] = t
+            t.start()
+
+    def strike_timer_done(self, device_id):
+        with self.strike_lock:
+            self.strike_timers.pop(device_id, None)
+        self.actors.submit_latest(device_id, self.publish_strikes, device_id)
+
+    def cancel_strike_timers(self, device_id=None):
+        with self.strike_lock:
+            for d in list(self.strike_timers) if device_id is None else [device_id]:
+                t = self.strike_timers.pop(d, None)
+                if t is not None:
+                    t.cancel()
+
+    def publish_strikes(self, device_id):
+        # This publishes everything so far, a held back publish isn't needed
+        self.cancel_strike_timers(device_id)
+        values, minutes = self.strikes.take(device_id, time.time())
+        node = self.poly.getNode(device_id)
+        if node is None or not hasattr(node, 'strike_drivers'):
+            return
+        lightning.publish(node, values, minutes, self.deviceList[device_id]['units'])
+
+    def send_rapid_wind_quiet(self, data):
+        self.send_rapid_wind(data, False)
+
+    def hub_status(self, data):
+        # This comes every 10 seconds, but we only update the driver
+        # during shortPoll, so just save it.
+        if "timestamp" in data:
+            self.hub_timestamp = max(self.hub_timestamp, data['timestamp'])
+        self.track_status(data)
+
+    def device_status(self, data):
+        self.track_status(data)
+
+    def track_status(self, data):
+        serial = data.get('serial_number')
+        if serial is None:
+            return
+        try:
+            firmware = int(data.get('firmware_revision') or 0)
+        except ValueError:
+            firmware = 0
+        if self.status.update(serial, time.time(), rssi=data.get('rssi') or 0,
+                hub_rssi=data.get('hub_rssi') or 0, voltage=data.get('voltage') or 0,
+                status=data.get('sensor_status') or 0, uptime=data.get('uptime') or 0,
+                firmware=firmware):
+            self.actors.submit_latest(hub.address(serial), self.publish_status, serial)
+
+    def publish_status(self, serial):
+        """ Runs in the status node's mailbox.  Creates the node if needed. """
+        address = hub.address(serial)
+        node = self.poly.getNode(address)
+        if node is None:
+            try:
+                if serial.startswith('HB'):
+                    node = hub.HubNode(self.poly, self.address, address, 'Hub ' + serial)
+                else:
+                    node = hub.StatusNode(self.poly, self.address, address, serial + ' Status')
+                LOGGER.info('Adding status node {}'.format(address))
+                self.poly.addNode(node)
+                self.nodesCreated += 1
+            except Exception as e:
+                LOGGER.error('Failed to create status node for {}: {}'.format(serial, e))
+                return
+        node.publish(self.status.values(serial), self.status.age(serial, time.time()))
+
+    def publish_age(self, serial):
+        node = self.poly.getNode(hub.address(serial))
+        if node is not None:
+            node.setDriver('ST', self.status.age(serial, time.time()), True, False, 57)
+
+    def send_rapid_wind(self, data, publish=True):
+        for d in list(self.deviceList):
+            device = self.deviceList[d]
+            if device['serial_number'] == data['serial_number']:
+                if self.accepts(device, data):
+                    if self.shards is not None:
+                        self.shards.rapid_wind(data['serial_number'], data['ob'], publish)
+                        self.actors.submit_latest(d, self.rapid_wind_stats, d, data['ob'])
+                    else:
+                        self.actors.submit_latest(d, self.update_rapid_wind, d, data['ob'], publish)
+                else:
+                    LOGGER.debug('device {} ignoring {} data.'.format(d, data.get('source', 'UDP')))
 
 
     def udp_data(self):
@@ -790,45 +1386,7 @@ class Controller(udi_interface.Node):
                 continue
             """
 
-            try:
-                if (data["type"] == "obs_air"):
-                    self.send_data(data)
-
-                if (data["type"] == "obs_st"):
-                    self.send_data(data)
-
-                if (data["type"] == "obs_sky"):
-                    self.send_data(data)
-
-                if (data["type"] == "rapid_wind"):
-                    if self.Parameters['Rapid Wind'].lower() == 'true':
-                        self.send_rapid_wind(data)
-            except Exception as e:
-                LOGGER.error('Failed to send data to ISY: {}'.format(e))
-
-
-            """
-            if (data["type"] == "device_status"):
-                if "AR" in data["serial_number"]:
-                    #self.setDriver('GV2', data['rssi'], report=True, force=True)
-                    self.nodes['hub'].update_rssi(data['rssi'], None)
-                    self.nodes['hub'].update_sensors(data['sensor_status'])
-                if "SK" in data["serial_number"]:
-                    #self.setDriver('GV3', data['rssi'], report=True, force=True)
-                    self.nodes['hub'].update_rssi(None, data['rssi'])
-                    self.nodes['hub'].update_sensors(data['sensor_status'])
-                if "ST" in data["serial_number"]:
-                    #self.setDriver('GV2', data['rssi'], report=True, force=True)
-                    self.nodes['hub'].update_rssi(data['rssi'])
-                    self.nodes['hub'].update_sensors(data['sensor_status'])
-            """
-
-            if (data["type"] == "hub_status"):
-                # This comes every 10 seconds, but we only update the driver
-                # during longPoll, so just save it.
-                #LOGGER.debug("hub_status: time={} {}".format(time.time(),data))
-                if "timestamp" in data:
-                    self.hub_timestamp = data['timestamp']
+            self.dispatcher.dispatch(data)
 
         s.close()
         self.stopped = True
@@ -838,6 +1396,7 @@ class Controller(udi_interface.Node):
     id = 'WeatherFlow'
 
     commands = {
+            'UPDATE_PROFILE': cmd_update_profile,
     }
 
     # Hub status information here: battery and rssi values.
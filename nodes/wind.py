@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+Rolling window wind statistics.
+"""
+import math
+from collections import deque
+
+
+class RollingWind(object):
+    """
+      Average wind over the last 'seconds' seconds.  Speed is the
+      scalar mean, direction is from the mean wind vector so that
+      359 and 1 degrees average to 0 and not 180.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()  # (ts, speed, u, v)
+        self.sum_speed = 0.0
+        self.sum_u = 0.0
+        self.sum_v = 0.0
+
+    def expire(self, now):
+        while self.samples and self.samples[0][0] <= now - self.seconds:
+            ts, speed, u, v = self.samples.popleft()
+            self.sum_speed -= speed
+            self.sum_u -= u
+            self.sum_v -= v
+
+        if not self.samples:
+            # start over so rounding errors don't build up
+            self.sum_speed = 0.0
+            self.sum_u = 0.0
+            self.sum_v = 0.0
+
+    def add(self, ts, speed, direction):
+        rad = math.radians(direction)
+        u = speed * math.sin(rad)
+        v = speed * math.cos(rad)
+        self.samples.append((ts, speed, u, v))
+        self.sum_speed += speed
+        self.sum_u += u
+        self.sum_v += v
+        self.expire(ts)
+
+    def speed(self):
+        if not self.samples:
+            return None
+        return max(self.sum_speed / len(self.samples), 0.0)
+
+    def direction(self):
+        if not self.samples:
+            return None
+        if abs(self.sum_u) < 1e-9 and abs(self.sum_v) < 1e-9:
+            return None  # calm, no direction
+        return round(math.degrees(math.atan2(self.sum_u, self.sum_v)) % 360, 0) % 360
+
+
+class PeakGust(object):
+    """
+      Highest gust over the last 'seconds' seconds.  The deque only
+      holds samples that can still become the peak, in decreasing order
+      of speed, so the peak is always at the front.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.samples = deque()  # (ts, speed, direction)
+
+    def add(self, ts, speed, direction):
+        while self.samples and self.samples[-1][1] <= speed:
+            self.samples.pop()
+        self.samples.append((ts, speed, direction))
+        self.expire(ts)
+
+    def expire(self, now):
+        while self.samples and self.samples[0][0] <= now - self.seconds:
+            self.samples.popleft()
+
+    def peak(self):
+        if not self.samples:
+            return None, None
+        return self.samples[0][1], self.samples[0][2]
+
+
+class WindStats(object):
+    """
+      2 minute and 10 minute average wind and the 10 minute peak gust.
+
+      rapid_wind samples (every 3 seconds) are used for the averages
+      when we are getting them.  Otherwise the averages come from the
+      observation packets.  All speeds are in m/s.
+    """
+    def __init__(self):
+        self.avg2 = RollingWind(120)
+        self.avg10 = RollingWind(600)
+        self.gust = PeakGust(600)
+        self.last_rapid = 0
+
+    def rapid(self, ts, speed, direction):
+        if speed is None or direction is None:
+            return
+        self.last_rapid = ts
+        self.avg2.add(ts, speed, direction)
+        self.avg10.add(ts, speed, direction)
+        self.gust.add(ts, speed, direction)
+
+    def observation(self, ts, avg, gust, direction):
+        if direction is None:
+            return
+
+        if avg is not None and (ts - self.last_rapid) > 60:
+            self.avg2.add(ts, avg, direction)
+            self.avg10.add(ts, avg, direction)
+        if gust is not None:
+            self.gust.add(ts, gust, direction)
+
+        self.avg2.expire(ts)
+        self.avg10.expire(ts)
+        self.gust.expire(ts)
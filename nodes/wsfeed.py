@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Polyglot v3 node server for WeatherFlow Weather Station data.
+Copyright (c) 2018,2019,2021 Robert Paauwe
+
+WeatherFlow realtime WebSocket feed.
+
+Instead of asking the REST API for each remote device every short poll,
+subscribe to the device's observations (listen_start) and rapid wind
+(listen_rapid_start) on the WebSocket feed.  The messages look like the
+UDP broadcasts except they have the device id instead of the serial
+number, so the serial number is added and they are handed to the same
+dispatcher as the UDP messages, tagged with 'source': 'websocket'.
+
+When the connection drops it's opened again with an increasing delay
+and every device is subscribed again.  Only the standard library is
+used, WebSocket framing is done here (RFC 6455, client side).
+"""
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+import udi_interface
+from urllib.parse import urlparse
+
+LOGGER = udi_interface.LOGGER
+
+DEFAULT_URL = 'wss://ws.weatherflow.com/swd/data'
+GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MIN_BACKOFF = 1         # seconds before the first reconnect
+MAX_BACKOFF = 300
+READ_TIMEOUT = 180      # reconnect if nothing arrives for this long
+
+OP_CONT = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+
+def _mask(key, data):
+    n = len(data)
+    k = (key * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(k, 'big')).to_bytes(n, 'big')
+
+def encode_frame(opcode, payload, mask=True):
+    """ One complete frame.  Clients must mask, servers must not. """
+    header = bytearray([0x80 | opcode])
+    n = len(payload)
+    bit = 0x80 if mask else 0
+    if n < 126:
+        header.append(bit | n)
+    elif n < 65536:
+        header.append(bit | 126)
+        header += struct.pack('>H', n)
+    else:
+        header.append(bit | 127)
+        header += struct.pack('>Q', n)
+    if mask:
+        key = os.urandom(4)
+        return bytes(header) + key + _mask(key, payload)
+    return bytes(header) + payload
+
+def read_frame(read):
+    """
+      Read one frame with read(n) and return (fin, opcode, payload).
+    """
+    b0, b1 = read(2)
+    n = b1 & 0x7f
+    if n == 126:
+        n = struct.unpack('>H', read(2))[0]
+    elif n == 127:
+        n = struct.unpack('>Q', read(8))[0]
+    key = read(4) if b1 & 0x80 else None
+    payload = read(n) if n else b''
+    if key is not None:
+        payload = _mask(key, payload)
+    return (b0 & 0x80) != 0, b0 & 0x0f, payload
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1((key + GUID).encode('ascii')).digest()).decode('ascii')
+
+
+class WebSocket(object):
+    """ A minimal WebSocket client for text messages """
+    def __init__(self, url, timeout=READ_TIMEOUT):
+        self.url = url
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+
+    def connect(self):
+        u = urlparse(self.url)
+        secure = u.scheme == 'wss'
+        port = u.port or (443 if secure else 80)
+        sock = socket.create_connection((u.hostname, port), timeout=30)
+        if secure:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=u.hostname)
+        self.sock = sock
+        self.buffer = b''
+
+        key = base64.b64encode(os.urandom(16)).decode('ascii')
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        request = ('GET {} HTTP/1.1\r\n'
+                   'Host: {}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   'Sec-WebSocket-Key: {}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n\r\n').format(path, u.netloc, key)
+        sock.sendall(request.encode('ascii'))
+
+        while b'\r\n\r\n' not in self.buffer:
+            self._fill()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        if len(lines[0].split()) < 2 or lines[0].split()[1] != '101':
+            raise ConnectionError('WebSocket upgrade refused: {}'.format(lines[0]))
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('sec-websocket-accept') != accept_key(key):
+            raise ConnectionError('WebSocket upgrade has the wrong accept key')
+        sock.settimeout(self.timeout)
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('Connection closed')
+        self.buffer += data
+
+    def _read(self, n):
+        while len(self.buffer) < n:
+            self._fill()
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def send(self, text):
+        self.sock.sendall(encode_frame(OP_TEXT, text.encode('utf-8')))
+
+    def recv(self):
+        """ Return the next text message, None once the server closes """
+        message = b''
+        while True:
+            fin, opcode, payload = read_frame(self._read)
+            if opcode == OP_PING:
+                self.sock.sendall(encode_frame(OP_PONG, payload))
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                try:
+                    self.sock.sendall(encode_frame(OP_CLOSE, payload[:2]))
+                except OSError:
+                    pass
+                return None
+            message += payload
+            if fin:
+                return message.decode('utf-8')
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(encode_frame(OP_CLOSE, struct.pack('>H', 1000)))
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
+
+
+class WSFeed(object):
+    """
+      Keep a subscription to every device in devices (device id ->
+      serial number) and pass what arrives to dispatch(data).
+    """
+    def __init__(self, url, token, devices, dispatch):
+        self.url = url
+        self.token = token
+        self.devices = dict(devices)
+        self.dispatch = dispatch
+        self.ws = None
+        self.thread = None
+        self.stopping = False
+        self.connected = False
+        self.seen = {}          # device id -> time of the last observation
+
+    def start(self):
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        ws = self.ws
+        if ws is not None:
+            ws.close()
+
+    def fresh(self, device_id, max_age=READ_TIMEOUT):
+        """ True if the feed delivered an observation for the device recently """
+        return self.connected and time.time() - self.seen.get(device_id, 0) < max_age
+
+    def _url(self):
+        sep = '&' if '?' in self.url else '?'
+        return self.url + sep + 'token=' + self.token
+
+    def _subscribe(self, ws):
+        for device_id in self.devices:
+            for kind in ('listen_start', 'listen_rapid_start'):
+                ws.send(json.dumps({'type': kind, 'device_id': device_id,
+                                    'id': '{}-{}'.format(kind, device_id)}))
+
+    def _run(self):
+        backoff = MIN_BACKOFF
+        while not self.stopping:
+            try:
+                self.ws = WebSocket(self._url())
+                self.ws.connect()
+                LOGGER.info('Connected to WebSocket feed {}'.format(self.url))
+                self._subscribe(self.ws)
+                self.connected = True
+                while not self.stopping:
+                    message = self.ws.recv()
+                    if message is None:
+                        break
+                    if self._handle(message):
+                        backoff = MIN_BACKOFF
+            except Exception as e:
+                if not self.stopping:
+                    LOGGER.warning('WebSocket feed failed: {}'.format(e))
+            finally:
+                self.connected = False
+                if self.ws is not None:
+                    self.ws.close()
+                    self.ws = None
+
+            if self.stopping:
+                break
+            delay = backoff * random.uniform(0.5, 1.0)
+            LOGGER.info('Reconnecting to WebSocket feed in {:.1f} seconds'.format(delay))
+            time.sleep(delay)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+
+    def _handle(self, message):
+        """ Returns True for device data """
+        try:
+            data = json.loads(message)
+        except ValueError:
+            LOGGER.error('Invalid WebSocket message {}'.format(message[:100]))
+            return False
+
+        serial = self.devices.get(data.get('device_id'))
+        if serial is None:
+            if data.get('type') not in ('connection_opened', 'ack'):
+                LOGGER.debug('WebSocket: {}'.format(message[:200]))
+            return False
+
+        data['serial_number'] = serial
+        data['source'] = 'websocket'
+        if data.get('type', '').startswith('obs_'):
+            self.seen[data['device_id']] = time.time()
+        self.dispatch(data)
+        return True
+
+
+if __name__ == '__main__':
+    # Run against a local stand-in server that drops the connection
+    # after a few messages to check reconnecting and resubscribing.
+    import socketserver
+
+    subscriptions = []
+
+    class StandIn(socketserver.BaseRequestHandler):
+        def handle(self):
+            buf = b''
+            while b'\r\n\r\n' not in buf:
+                buf += self.request.recv(4096)
+            head = buf.split(b'\r\n\r\n', 1)[0].decode('latin-1')
+            key = [l.split(':', 1)[1].strip() for l in head.split('\r\n') if l.lower().startswith('sec-websocket-key')][0]
+            self.request.sendall(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                                  'Connection: Upgrade\r\nSec-WebSocket-Accept: {}\r\n\r\n').format(accept_key(key)).encode())
+            f = self.request.makefile('rb')
+            send = lambda d: self.request.sendall(encode_frame(OP_TEXT, json.dumps(d).encode(), mask=False))
+            send({'type': 'connection_opened'})
+            for i in range(2):
+                fin, op, payload = read_frame(f.read)
+                msg = json.loads(payload)
+                subscriptions.append(msg['type'])
+                send({'type': 'ack', 'id': msg['id']})
+            self.request.sendall(encode_frame(OP_PING, b'hi', mask=False))
+            for i in range(3):
+                send({'type': 'obs_st', 'device_id': 1234, 'obs': [[int(time.time()), 0, 1, 2, 90]]})
+                send({'type': 'rapid_wind', 'device_id': 1234, 'ob': [int(time.time()), 1.5, 90]})
+            self.request.sendall(encode_frame(OP_CLOSE, struct.pack('>H', 1000), mask=False))
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    MIN_BACKOFF = 0.1
+
+    received = []
+    feed = WSFeed('ws://127.0.0.1:{}/swd/data'.format(server.server_address[1]), 'token',
+                  {1234: 'ST-00001234'}, received.append)
+    feed.start()
+    deadline = time.time() + 10
+    while len(received) < 12 and time.time() < deadline:
+        time.sleep(0.05)
+    feed.stop()
+    server.shutdown()
+    print('received {} messages over {} connections, subscriptions {}'.format(
+        len(received), subscriptions.count('listen_start'), subscriptions))
+    print(received[0])